@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Az mnsz2korapxml.py konverziójának benchmarkja szintetikus NoSkE/clean korpuszon. A konverzió lépéseit
+(read(), NoSkE parse, clean metaadatok, get_data_and_annotations(), a gen_xml() opciói és a kiírás) külön
+méri, és a lépésenkénti időt, token/s-t, MB/s-t és a folyamat addigi csúcs memóriahasználatát JSON-ben adja meg.
+Két verzió eredménye összevethető (-r), így a lassulások még a teljes korpuszon való futtatás előtt kiderülnek.
+"""
+
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import json
+import mmap
+import argparse
+from contextlib import redirect_stdout
+from functools import partial
+
+import mnsz2korapxml as m2k
+
+# (szóalak, lemma, pos, ctag, msd, word_cv, word_syll, lemma_cv, lemma_syll, word_phon, lemma_phon)
+WORDS = (
+    ('Most', 'most', 'HA', 'R__R', 'compound=n;;hyphenated=n;;stem=most::HA;;mboundary=most',
+     'CBCC', '1', 'CBCC', '1', 'most', 'most'),
+    ('az', 'az', 'DET', 'D__D', 'compound=n;;hyphenated=n;;stem=az::DET;;mboundary=az',
+     'BC', '1', 'BC', '1', 'az', 'az'),
+    ('ünnepre', 'ünnep', 'FN.SUB', 'NS3NS',
+     'compound=n;;hyphenated=n;;stem=ünnep::FN;;morphemes=re::SUB;;mboundary=ünnep+re',
+     'FCCNCCN', '3', 'FCCNC', '2', 'ünnepre', 'ünnep'),
+    ('ne', 'ne', 'HA', 'R__R', 'compound=n;;hyphenated=n;;stem=ne::HA;;mboundary=ne',
+     'CN', '1', 'CN', '1', 'ne', 'ne'),
+    ('gondolj', 'gondol', 'IGE.Pe2', 'VS2SI',
+     'compound=n;;hyphenated=n;;stem=gondol::IGE;;morphemes=j::Pe2;;mboundary=gondol+j',
+     'CBCCBCC', '2', 'CBCCBC', '2', 'gondolj', 'gondol'),
+    ('szállásodra', 'szállás', 'FN.PSe2.SUB', 'NS3NSS2',
+     'compound=n;;hyphenated=n;;stem=száll::IGE;;morphemes=ra::SUB od::PSe2 ás::_IF;;mboundary=száll+ás+od+ra',
+     'CBCCBCBCCB', '4', 'CBCCBC', '2', 'Sállásodra', 'Sállás'),
+    ('pásztorokat', 'pásztor', 'FN.PL.ACC', 'NP3NA',
+     'compound=n;;hyphenated=n;;stem=pásztor::FN;;morphemes=ok::PL at::ACC;;mboundary=pásztor+ok+at',
+     'CBCCBCBCBC', '4', 'CBCCBC', '2', 'pásztorokat', 'pásztor'),
+    ('hallgass', 'hallgat', 'IGE.Pe2', 'VS2SI',
+     'compound=n;;hyphenated=n;;stem=hallgat::IGE;;morphemes=s::Pe2;;mboundary=hallgat+s',
+     'CBCCCBC', '2', 'CBCCCBC', '2', 'halgass', 'halgat'),
+    ('árva', 'árva', 'MN.NOM', 'AS3NN',
+     'compound=n;;hyphenated=n;;stem=árva::MN;;morphemes=ZERO::NOM;;mboundary=árva',
+     'BCCB', '2', 'BCCB', '2', 'árva', 'árva'),
+    ('énekes', 'énekes', 'FN.NOM', 'NS3NN',
+     'compound=n;;hyphenated=n;;stem=ének::FN;;morphemes=es::_KEP;;mboundary=ének+es',
+     'BCBCBC', '3', 'BCBCBC', '3', 'énekes', 'énekes'),
+)
+PUNCTS = (',', '.', '!', '?', ';')
+PUNCT_ANNOTATION = '\t'.join(('WPUNCT', '__WPUNCT__', *('__NA__',) * 7))
+
+CLEAN_HEADER = '''<?xml version="1.0" encoding="iso-8859-2" standalone="no"?>
+<!DOCTYPE cesDoc SYSTEM "/home/projects/mnsz2/dtd/hncxml.dtd"
+[]>
+<cesDoc type="text" version="1.0" TEIform="TEI.2">
+  <cesHeader type="text" status="new" version="1.0" TEIform="teiHeader">
+    <fileDesc>
+      <titleStmt>
+          <h.title>Magyar Nemzeti Szövegtár: {title}</h.title>
+      </titleStmt>
+      <publicationStmt>
+ <distributor>MTA NYTI</distributor>
+ <pubAddress>Bp.</pubAddress>
+ <availability region="world" status="unknown">Szabad</availability>
+ <pubDate>2003/01/29</pubDate>
+      </publicationStmt>
+    </fileDesc>
+    <profileDesc>
+      <langUsage>
+ <language id="hu" iso639="hu">Hungarian</language>
+      </langUsage>
+    </profileDesc>
+  </cesHeader>
+  <text complete="y">
+    <body lang="hu">
+'''
+CLEAN_FOOTER = '''    </body>
+  </text>
+</cesDoc>
+'''
+
+
+def gen_sentence(rand, num_of_tokens, nospace_density):
+    """
+    :return: 1: a mondat NoSkE sorai, 2: a mondat szövege a clean fájlhoz
+    """
+    lines = []
+    words = []
+
+    for k in range(num_of_tokens):
+        if k > 0 and rand.random() < nospace_density:
+            # NoSpace és írásjel (a NoSkE fájlokban a <g/> az írásjel előtt áll)
+            punct = rand.choice(PUNCTS)
+            lines.extend(('<g/>', f'{punct}\t{punct}\t{PUNCT_ANNOTATION}'))
+            words[-1] += punct
+        else:
+            word = rand.choice(WORDS)
+            lines.append('\t'.join(word))
+            words.append(word[0])
+
+    return lines, ' '.join(words)
+
+
+def gen_corpus(corpus_dir, num_of_files, num_of_divs, num_of_sentences, num_of_tokens, nospace_density, seed):
+    """
+    Szintetikus NoSkE és clean fájlok létrehozása (ISO-8859-2 kódolással, ahogy az MNSZ2-ben).
+    :return: {NoSkE fájl: clean fájl}
+    """
+    rand = random.Random(seed)
+    noske_dir = os.path.join(corpus_dir, 'noske')
+    clean_dir = os.path.join(corpus_dir, 'clean')
+    os.makedirs(noske_dir)
+    os.makedirs(clean_dir)
+    noske_clean_files_dict = {}
+
+    for i in range(num_of_files):
+        fname_wo_ext = f'bench_hu_synthetic_{i:03}'
+        noske_lines = [f'<doc file="{fname_wo_ext}" style="szépirodalom" region="magyarországi">']
+        clean_lines = [CLEAN_HEADER.format(title=fname_wo_ext)]
+
+        for j in range(num_of_divs):
+            head_lines, head_text = gen_sentence(rand, 4, 0)
+            noske_lines.extend(('<div type="article">', '<head>', '<s>', *head_lines, '</s>', '</head>', '<p>'))
+            clean_lines.extend(('<div type="article">', f'<head>{head_text}</head>',
+                                f'<docAuthor>Szerző {j}</docAuthor>', f'<date>{1950 + j % 70}</date>', '<p>'))
+
+            for k in range(num_of_sentences):
+                if k > 0 and k % 5 == 0:
+                    noske_lines.extend(('</p>', '<p>'))
+                    clean_lines.extend(('</p>', '<p>'))
+                s_lines, s_text = gen_sentence(rand, num_of_tokens, nospace_density)
+                noske_lines.extend(('<s>', *s_lines, '</s>'))
+                clean_lines.append(s_text)
+
+            noske_lines.extend(('</p>', '</div>'))
+            clean_lines.extend(('</p>', '</div>'))
+
+        noske_lines.append('</doc>')
+        clean_lines.append(CLEAN_FOOTER)
+
+        noske_file = os.path.join(noske_dir, f'source.{fname_wo_ext}.mxml')
+        clean_file = os.path.join(clean_dir, f'{fname_wo_ext}.xml')
+        with open(noske_file, 'w', encoding='iso-8859-2') as f:
+            f.write('\n'.join(noske_lines) + '\n')
+        with open(clean_file, 'w', encoding='iso-8859-2') as f:
+            f.write('\n'.join(clean_lines))
+        noske_clean_files_dict[noske_file] = clean_file
+
+    return noske_clean_files_dict
+
+
+def peak_rss_mb():
+    # Linuxon a ru_maxrss kB-ban van
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def collect_output(outputs, relpath, chunks):
+    outputs.append((relpath, ''.join(chunks)))
+
+
+def run_benchmark(noske_clean_files_dict, output_dir, stages, opts=m2k.OPTS):
+    """
+    A konverzió lépéseinek egymás utáni, külön mérése. Minden lépés az előző eredményéből dolgozik,
+    a mérés körül nincs más munka.
+    """
+    noske_bytes = sum(os.path.getsize(noske_file) for noske_file in noske_clean_files_dict)
+    corpora_dir = os.path.join(output_dir, 'benchKorAP')
+    journal_state = {os.path.basename(noske_file): (i, 0, None)
+                     for i, noske_file in enumerate(noske_clean_files_dict, start=1)}
+    corpus = {'noske_files': len(noske_clean_files_dict), 'noske_bytes': noske_bytes,
+              'clean_bytes': sum(os.path.getsize(clean_file) for clean_file in noske_clean_files_dict.values())}
+
+    def measure(stage_name, func, *func_args, num_of_bytes=None):
+        # A lépés bemenete argumentumként jön, nem a lépés függvényének closure-jéből, így a mérés után
+        # törölt (del) bemenetekre nem maradhat hivatkozás
+        start = time.perf_counter()
+        result = func(*func_args)
+        seconds = time.perf_counter() - start
+        stages[stage_name] = {'seconds': round(seconds, 4),
+                              'tokens_per_sec': round(corpus.get('tokens', 0) / seconds, 1) if seconds else None,
+                              'mb_per_sec': round(((num_of_bytes or noske_bytes) / 2 ** 20) / seconds, 3)
+                              if seconds else None,
+                              'peak_rss_mb': round(peak_rss_mb(), 1)}
+        print(f'{stage_name:<24}{seconds:>10.3f} s', file=sys.stderr)
+        return result
+
+    def read():
+        noske_inps = list(m2k.read(noske_clean_files_dict, journal_state))
+        # A read() csak memóriába képezi a fájlokat, ezért a lépés minden lapjukat be is olvassa,
+        # különben csak az mmap létrehozását mérné, és a beolvasás ideje a parse lépéshez számítana
+        for _, _, noske_xml, _, _, _ in noske_inps:
+            for i in range(0, len(noske_xml), mmap.PAGESIZE):
+                noske_xml[i]
+        return noske_inps
+
+    noske_inps = measure('read', read)
+
+    def parse(noske_inps):
+        return [(noske_fname, clean_xml_path, parent_number,
+                 m2k.parse_noske_xml(noske_xml).find_all('div'))
+                for noske_fname, clean_xml_path, noske_xml, parent_number, _, _ in noske_inps]
+
+    parsed_files = measure('parse', parse, noske_inps)
+    del noske_inps
+    clean_metadata = measure('clean_metadata',
+                             lambda: {clean_xml_path: m2k.load_clean_metadata(clean_xml_path)
+                                      for clean_xml_path in noske_clean_files_dict.values()},
+                             num_of_bytes=corpus['clean_bytes'])
+    divs = [(clean_xml_path, parent_number, j, div) for _, clean_xml_path, parent_number, noske_divs in parsed_files
+            for j, div in enumerate(noske_divs)]
+    corpus['divs'] = len(divs)
+
+    def get_data_and_annotations(divs):
+        datas = []
+        token_tables = []
+        for _, _, _, div in divs:
+            token_table = m2k.new_token_table()
+            datas.append(m2k.get_data_and_annotations(div, token_table))
+            token_tables.append(token_table)
+        return datas, token_tables
+
+    datas, token_tables = measure('get_data_and_annotations', get_data_and_annotations, divs)
+    corpus['tokens'] = sum(len(token_table['word']) for token_table in token_tables)
+    # A get_data_and_annotations() és az előző lépések token/s értéke a token tábla után számolható
+    for stage in stages.values():
+        stage['tokens_per_sec'] = round(corpus['tokens'] / stage['seconds'], 1) if stage['seconds'] else None
+
+    offsets = measure('compute_offsets', lambda: [m2k.compute_offsets(token_table) for token_table in token_tables])
+    meta_dicts = [{'fname_wo_ext': '', 'token_table': token_table, 'data': data, 'offsets': div_offsets,
+                   'clean_div': clean_metadata[clean_xml_path][1][j],
+                   'corpora_dir': os.path.basename(corpora_dir),
+                   'parent_folder_name': f'DOC{m2k.gen_docname("000000", parent_number)}',
+                   'child_folder_name': m2k.gen_docname('000000', j + 1)}
+                  for (clean_xml_path, parent_number, j, _), data, token_table, div_offsets
+                  in zip(divs, datas, token_tables, offsets)]
+    del parsed_files, divs
+
+    # A gen_xml() opciónként, a szerializálással együtt (write_outputs()), de a fájlba írás nélkül.
+    # Az fs részfák cache-e minden lépés előtt üres, hogy a lépések egymástól függetlenek legyenek.
+    outputs = []
+    for opt in opts:
+        opt_outputs = []
+        m2k.gen_fs_fragment.cache_clear()
+        measure(f'gen_xml:{opt}', lambda meta_dicts: m2k.write_outputs(((m2k.gen_xml(meta_dict, opt),
+                                                                        meta_dict['parent_folder_name'],
+                                                                        meta_dict['child_folder_name'])
+                                                                       for meta_dict in meta_dicts),
+                                                                      partial(collect_output, opt_outputs)),
+                meta_dicts)
+        stages[f'gen_xml:{opt}']['mb_per_sec'] = \
+            round(sum(len(output_xml.encode('utf-8')) for _, output_xml in opt_outputs) / 2 ** 20 /
+                  stages[f'gen_xml:{opt}']['seconds'], 3) if stages[f'gen_xml:{opt}']['seconds'] else None
+        cache_info = m2k.gen_fs_fragment.cache_info()
+        if cache_info.hits + cache_info.misses:
+            stages[f'gen_xml:{opt}']['fs_cache_hit_rate'] = \
+                round(cache_info.hits / (cache_info.hits + cache_info.misses), 4)
+        outputs.extend(opt_outputs)
+    del meta_dicts
+
+    output_bytes = sum(len(output_xml.encode('utf-8')) for _, output_xml in outputs)
+    corpus['output_files'] = len(outputs)
+    corpus['output_bytes'] = output_bytes
+
+    def write(outputs):
+        for relpath, output_xml in outputs:
+            m2k.write_file_output(corpora_dir, relpath, (output_xml,))
+
+    measure('write', write, outputs, num_of_bytes=output_bytes)
+    del outputs
+    shutil.rmtree(corpora_dir)
+
+    # A teljes soros konverzió (process_documents() és a kiírás) mindkét beolvasási módban. A process_documents()
+    # a stdout-ra írja a fájlneveket, ami a JSON kimenetet elrontaná.
+    for stage_name, streaming in (('end_to_end', False), ('end_to_end_streaming', True)):
+        m2k.gen_fs_fragment.cache_clear()
+        with redirect_stdout(sys.stderr):
+            measure(stage_name, lambda: m2k.write_outputs(
+                m2k.process_documents(m2k.read(noske_clean_files_dict, journal_state, streaming), corpora_dir, None,
+                                      streaming, journal_records=[], opts=opts),
+                partial(m2k.write_file_output, corpora_dir)))
+        shutil.rmtree(corpora_dir)
+
+    return corpus
+
+
+def compare_with_baseline(stages, baseline_filepath, tolerance):
+    """
+    :return: a baseline-hoz képest tolerance-nél többet lassult lépések
+    """
+    with open(baseline_filepath, encoding='utf-8') as f:
+        baseline_stages = json.load(f)['stages']
+
+    regressions = []
+    for stage_name, stage in stages.items():
+        if stage_name not in baseline_stages or not baseline_stages[stage_name]['seconds']:
+            continue
+        ratio = stage['seconds'] / baseline_stages[stage_name]['seconds']
+        stage['baseline_ratio'] = round(ratio, 3)
+        if ratio > 1 + tolerance:
+            regressions.append(f'{stage_name}: {baseline_stages[stage_name]["seconds"]} s -> {stage["seconds"]} s')
+
+    return regressions
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark of the MNSZ NoSkE to KorAP-XML conversion '
+                                                 'on a synthetic corpus.')
+    parser.add_argument('-f', '--files', help='Number of NoSkE files.', type=int, default=10)
+    parser.add_argument('-d', '--divs', help='Number of divs per NoSkE file.', type=int, default=10)
+    parser.add_argument('-s', '--sentences', help='Number of sentences per div.', type=int, default=50)
+    parser.add_argument('-t', '--tokens', help='Number of tokens per sentence.', type=int, default=15)
+    parser.add_argument('-n', '--nospace_density', help='Probability of a NoSpace (<g/>) and punctuation '
+                                                        'instead of a word token.', type=float, default=0.1)
+    parser.add_argument('--seed', help='Seed of the synthetic corpus generator.', type=int, default=1)
+    parser.add_argument('-w', '--work_dir', help='Directory for the synthetic corpus and the output, '
+                                                 'a temporary directory by default.', nargs='?', default=None)
+    parser.add_argument('-l', '--layers', help='Comma separated list of the measured layers (see mnsz2korapxml.py '
+                                               '--layers).', type=m2k.parse_layers, default=m2k.OPTS)
+    parser.add_argument('-o', '--output', help='Path of the JSON report, stdout by default.', nargs='?',
+                        default=None)
+    parser.add_argument('-r', '--baseline', help='JSON report of an earlier run. Exits with an error if a stage '
+                                                 'is slower by more than the tolerance.', nargs='?', default=None)
+    parser.add_argument('--tolerance', help='Allowed slowdown compared to the baseline (0.2 = 20%%).',
+                        type=float, default=0.2)
+    return vars(parser.parse_args())
+
+
+def main():
+    args = get_args()
+    work_dir = tempfile.mkdtemp(prefix='mnsz2korap_benchmark_', dir=args['work_dir'])
+    stages = {}
+
+    try:
+        noske_clean_files_dict = gen_corpus(os.path.join(work_dir, 'corpus'), args['files'], args['divs'],
+                                            args['sentences'], args['tokens'], args['nospace_density'], args['seed'])
+        corpus = run_benchmark(noske_clean_files_dict, work_dir, stages, args['layers'])
+    finally:
+        shutil.rmtree(work_dir)
+
+    regressions = []
+    if args['baseline'] is not None:
+        regressions = compare_with_baseline(stages, args['baseline'], args['tolerance'])
+
+    report = {'params': {param: args[param] for param in ('files', 'divs', 'sentences', 'tokens',
+                                                          'nospace_density', 'seed', 'layers')},
+              'python': platform.python_version(), 'corpus': corpus, 'stages': stages,
+              'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+    if args['output'] is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args['output'], 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+
+    if len(regressions) > 0:
+        raise SystemExit('Slower than the baseline:\n' + '\n'.join(regressions))
+
+
+if __name__ == '__main__':
+    main()
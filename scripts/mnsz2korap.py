@@ -0,0 +1,11 @@
+#! /usr/bin/env python3
+"""
+Az mnsz2korapxml.py parancsainak (plan, status, convert, verify) indítója. Az mnsz2korapxml-t modulként importálja,
+így a lefordított változata a __pycache__-ből töltődik be, és nem fordul le minden indításkor újra, ami a konvertálás
+nélküli parancsok futásidejének nagyobb része lenne.
+"""
+
+import mnsz2korapxml
+
+if __name__ == '__main__':
+    mnsz2korapxml.main()
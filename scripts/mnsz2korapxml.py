@@ -1,11 +1,29 @@
 #! /usr/bin/env python3
 
-from bs4 import BeautifulSoup
 import os
 import shutil
+import sqlite3
+import time
+import tempfile
+import zipfile
+import zlib
 import argparse
-from glob import iglob
+import hashlib
+import json
+import mmap
+import sys
+import io
+import gzip
+from array import array
+from collections import deque
+from contextlib import closing
+from functools import lru_cache, partial
+import fnmatch
+from itertools import chain, groupby
+from operator import is_, itemgetter
 import re
+from sys import intern
+from xml.etree import ElementTree
 
 # 11 oszlop van. (TSV)
 #
@@ -36,6 +54,7 @@ ANNOTATION_TYPES_ORDERED = (
     'word_phon',
     'lemma_phon')
 
+# Az alapértelmezetten generált rétegek, a többi OPT_DICT-beli réteg a --layers kapcsolóval kérhető
 OPTS = (
     'header',
     'data',
@@ -53,28 +72,25 @@ OPTS = (
     # 'lemma_phon'
 )
 
+# A rétegek nyilvántartása: réteg --> (annotációk, kimeneti fájlnév, annotációs mappa)
 OPT_DICT = {
     'header': (None, 'header', ''),
     'data': (None, 'data', ''),
     'sentences': (None, 'sentences', 'base'),
     'paragraphs': (None, 'paragraphs', 'base'),
     'word': (None, 'tokens', 'noske'),
-    # 'lemma': (('lemma',), 'lemma', 'noske'),
-    # 'pos': (('word', 'lemma', 'pos'), 'part-of-speech', 'noske'),
+    'lemma': (('lemma',), 'lemma', 'noske'),
+    'pos': (('word', 'lemma', 'pos'), 'part-of-speech', 'noske'),
     # 'msd': (('lemma', 'pos', 'msd'), 'morpho', 'noske'),
     'msd': (('lemma', 'pos', 'msd'), 'morpho', 'hnc'),
-    # 'word_cv': (('word', 'word_cv'), 'word_cv', 'noske'),
-    # 'word_syll': (('word', 'word_syll'), 'word_syll', 'noske'),
-    # 'lemma_cv': (('lemma', 'lemma_cv'), 'lemma_cv', 'noske'),
-    # 'lemma_syll': (('lemma', 'lemma_syll'), 'lemma_syll', 'noske'),
-    # 'word_phon': (('word', 'word_phon'), 'word_phon', 'noske'),
-    # 'lemma_phon': (('lemma', 'lemma_phon'), 'lemma_phon', 'noske')
+    'word_cv': (('word', 'word_cv'), 'word_cv', 'noske'),
+    'word_syll': (('word', 'word_syll'), 'word_syll', 'noske'),
+    'lemma_cv': (('lemma', 'lemma_cv'), 'lemma_cv', 'noske'),
+    'lemma_syll': (('lemma', 'lemma_syll'), 'lemma_syll', 'noske'),
+    'word_phon': (('word', 'word_phon'), 'word_phon', 'noske'),
+    'lemma_phon': (('lemma', 'lemma_phon'), 'lemma_phon', 'noske')
 }
 
-PAT_CUT_SPACE = re.compile(r' ?NoSpace ?')
-
-STOPS = ('SSTOP', 'PSTOP')
-
 BASE = ('paragraphs', 'sentences', 'header', 'data')
 
 FS_ATTRS = {'type': 'lex', 'xmlns': 'http://www.tei-c.org/ns/1.0'}
@@ -83,11 +99,8 @@ F2_ATTRS = {'name': 'lex'}
 
 F4_ATTRS = {'name': ''}
 
-ANNOT_SPAN_ATTRS = {'id': '',
-                    'from': '',
-                    'to': ''}
-
-BASE_SPAN_ATTRS = {'from': '', 'to': ''}
+# A gen_fs_fragment() cache-ében tárolt fs részfák legnagyobb száma (egy részfa néhány száz bájt)
+FS_FRAGMENT_CACHE_SIZE = 1 << 15
 
 LAYER_ATTRS = {'docid': '',
                'xmlns': 'http://ids-mannheim.de/ns/KorAP',
@@ -96,152 +109,603 @@ LAYER_ATTRS = {'docid': '',
 RAW_TEXT_ATTRS = {'docid': '',
                   'xmlns': 'http://ids-mannheim.de/ns/KorAP'}
 
-PAT_CES_HEADER = re.compile(r'<cesHeader.+?(</cesHeader>)', re.DOTALL | re.MULTILINE)
-
 PAT_SPLITTED_FILES = re.compile(r'(.*?)(?:_\d{3})(\.clean)?\.mxml')
 
+SPAN_LAYER_TAIL = ' </spanList>\n' \
+                  '</layer>'
+
+# A darabolt feldolgozásnál (gen_chunked_outputs()) a data.xml eleje és vége a gen_data_xml() kimenetéből, ennek
+# a helyére kerül a szöveg
+DATA_PLACEHOLDER = 'MNSZ2KORAP_DATA'
+
+# A Krill JSON kimenet (gen_krill_json()) rétegeinek rövid nevei, a többi annotáció a saját nevén kerül be
+KRILL_LAYER_KEYS = {'lemma': 'l', 'pos': 'p', 'msd': 'm'}
+
+KRILL_CONTEXT = 'http://korap.ids-mannheim.de/ns/koral/0.4/context.jsonld'
+
+PAT_KRILL_DATE = re.compile(r'\d{4}(?:-\d{2}(?:-\d{2})?)?')
+
+# A kimenet span rétegeinek olvasásához (read_layer_spans())
+PAT_LAYER_SPAN = re.compile(rb'<span\b(?=[^>]*\bfrom="(-?\d+)")(?=[^>]*\bto="(-?\d+)")')
+PAT_WORD_FEATURE = re.compile(rb'<f name="word">\s*(.*?)\s*</f>', re.DOTALL)
+
+# A 3rd_level_header a korábbi BeautifulSoup prettify() kimenetével megegyező váza (format_header_text())
+HEADER_3RD_LEVEL_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<?xml-model href="header.rng" type="application/xml" schematypens="http://relaxng.org/ns/structure/1.0"?>\n'
+    '<!DOCTYPE idsCorpus PUBLIC "-//IDS//DTD IDS-XCES 1.0//EN" '
+    '"http://corpora.ids-mannheim.de/idsxces1/DTD/ids.xcesdoc.dtd">\n'
+    '<idsHeader type="text">\n'
+    ' <fileDesc>\n'
+    '  <titleStmt>\n'
+    '   <textSigle>\n'
+    '{text_sigle}'
+    '   </textSigle>\n'
+    '   <t.title>\n'
+    '{t_title}'
+    '   </t.title>\n'
+    '  </titleStmt>\n'
+    '  <publicationStmt>\n'
+    '  </publicationStmt>\n'
+    '  <sourceDesc>\n'
+    '   <biblStruct>\n'
+    '    <analytic>\n'
+    '     <h.author>\n'
+    '{h_author}'
+    '     </h.author>\n'
+    '    </analytic>\n'
+    '   </biblStruct>\n'
+    '  </sourceDesc>\n'
+    ' </fileDesc>\n'
+    ' <encodingDesc>\n'
+    ' </encodingDesc>\n'
+    ' <profileDesc>\n'
+    '  <creation>\n'
+    '   <creatDate>\n'
+    '{creat_date}'
+    '   </creatDate>\n'
+    '  </creation>\n'
+    ' </profileDesc>\n'
+    '</idsHeader>'
+)
+
+# A bs4 és az lxml (a soupsieve-vel együtt) importálása a konvertálás nélküli parancsok (plan, status, verify) teljes
+# futásidejénél is tovább tart, ezért csak az első parse-oláskor töltődnek be (import_parsers())
+BeautifulSoup = CData = NavigableString = etree = None
+
+# A BeautifulSoup .text csak ezeket a szöveg típusokat adja vissza (a kommenteket és a PI-ket nem)
+SOUP_TEXT_TYPES = ()
+
+# A clean div-ekből a 3rd_level_header-hez kinyert tagek (html.parser: kisbetűs tagnevek)
+CLEAN_DIV_META_TAGS = ('head', 'docauthor', 'date')
+
+JOURNAL_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (noske_file TEXT PRIMARY KEY, parent_number INTEGER UNIQUE NOT NULL,
+                                  num_of_done_divs INTEGER NOT NULL DEFAULT 0, num_of_divs INTEGER,
+                                  noske_digest TEXT, clean_file TEXT, clean_digest TEXT);
+CREATE TABLE IF NOT EXISTS inputs (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, digest TEXT);
+CREATE TABLE IF NOT EXISTS shard (shard_index INTEGER, num_of_shards INTEGER, output TEXT, corpus_name TEXT);
+'''
+
+METADATA_INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS clean_files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, ces_header TEXT);
+CREATE TABLE IF NOT EXISTS clean_divs (path TEXT, div_index INTEGER, head TEXT, docauthor TEXT, date TEXT,
+                                       PRIMARY KEY (path, div_index));
+'''
+
+
+CLEAN_MANIFEST_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, subdirs TEXT, files TEXT);
+'''
+
+# A main() parancsai, a convert az alapértelmezett
+COMMANDS = ('plan', 'status', 'convert', 'verify')
+
+PAT_GLOB_MAGIC = re.compile(r'[*?[]')
 
-def writing_backup_file(backup_filepath, create_new_backup_file, last_file_infos=None):
-    if create_new_backup_file:
-        with open(backup_filepath, 'w', encoding='utf-8') as outpf:
-            pass
-    else:
-        with open(backup_filepath, 'a', encoding='utf-8') as outpf:
-            print('\t'.join(last_file_infos), file=outpf)
+
+def import_parsers():
+    """
+    A bs4 és az lxml betöltése. A NoSkE és clean fájlokat parse-oló függvények hívják, a párhuzamos futtatás
+    folyamataiban is ezek töltik be őket.
+    """
+    global BeautifulSoup, CData, NavigableString, etree, SOUP_TEXT_TYPES
+
+    if etree is None:
+        from bs4 import BeautifulSoup, CData, NavigableString
+        from lxml import etree
+        SOUP_TEXT_TYPES = (NavigableString, CData)
 
 
-def loading_backup_file(backup_filepath, create_new):
-    # filenév, id, child id
+def open_journal(journal_filepath, create_new):
+    """
+    A konverzió állapotát tároló SQLite napló (WAL módban) megnyitása. NoSkE fájlonként tárolja a kiosztott
+    DOC sorszámot, a kész div-ek számát, a kész fájlok div-jeinek számát, valamint a NoSkE és a clean bemenet
+    tartalmának hash-ét, amelyből a kimenet készült (update_input_manifest()).
+    """
     if create_new:
-        writing_backup_file(backup_filepath, create_new)
-        return 0, 0, None, set()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(f'{journal_filepath}{suffix}')
+            except FileNotFoundError:
+                pass
+
+    journal = sqlite3.connect(journal_filepath)
+    journal.execute('PRAGMA journal_mode=WAL')
+    # WAL módban a NORMAL a folyamat összeomlását biztonságosan túléli, és nem fsync-el minden commitnál
+    journal.execute('PRAGMA synchronous=NORMAL')
+    journal.executescript(JOURNAL_SCHEMA)
+    return journal
+
+
+def load_journal(journal, noske_files, parent_numbers=None):
+    """
+    A napló betöltése egyetlen lekérdezéssel. Az új NoSkE fájlok a naplóban lévő legnagyobb után következő
+    DOC sorszámokat kapják (a bemenet sorrendjében), a már szereplők sorszáma nem változik.
+    :param parent_numbers: shard módban a teljes bemenet szerinti DOC sorszámok (select_shard()), az új NoSkE fájlok
+                           ezeket kapják
+    :return: {NoSkE fájlnév: (DOC sorszám, kész div-ek száma, div-ek száma, ha a fájl kész, különben None)}
+    """
+    journal_state = {noske_fname: (parent_number, num_of_done_divs, num_of_divs)
+                     for noske_fname, parent_number, num_of_done_divs, num_of_divs
+                     in journal.execute('SELECT noske_file, parent_number, num_of_done_divs, num_of_divs FROM files')}
+    last_parent_folder_number = max((parent_number for parent_number, _, _ in journal_state.values()), default=0)
+    new_files = []
+
+    for noske_file in noske_files:
+        noske_fname = os.path.basename(noske_file)
+        if noske_fname not in journal_state:
+            if parent_numbers is None:
+                last_parent_folder_number += 1
+                parent_number = last_parent_folder_number
+            else:
+                parent_number = parent_numbers[noske_fname]
+            journal_state[noske_fname] = (parent_number, 0, None)
+            new_files.append((noske_fname, parent_number))
+
+    with journal:
+        journal.executemany('INSERT INTO files (noske_file, parent_number) VALUES (?, ?)', new_files)
+
+    return journal_state
+
 
-    line = ''
-    processed_files = set()
+def file_digest(filepath):
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(partial(f.read, 1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
 
+
+def get_input_digests(journal, filepaths):
+    """
+    A bemeneti fájlok tartalmának hash-e. Csak azokat a fájlokat olvassa be, amelyeknek az mtime-ja vagy a mérete
+    megváltozott a naplóban tárolthoz képest.
+    :return: {abszolút elérési út: hash}
+    """
+    known_inputs = {path: (mtime_ns, size, digest)
+                    for path, mtime_ns, size, digest in journal.execute('SELECT path, mtime_ns, size, digest '
+                                                                        'FROM inputs')}
+    digests = {}
+    changed_inputs = []
+
+    for filepath in filepaths:
+        filepath = os.path.abspath(filepath)
+        if filepath in digests:
+            continue
+        file_stat = os.stat(filepath)
+        mtime_ns, size, digest = known_inputs.get(filepath, (None, None, None))
+        if (mtime_ns, size) != (file_stat.st_mtime_ns, file_stat.st_size):
+            digest = file_digest(filepath)
+            changed_inputs.append((filepath, file_stat.st_mtime_ns, file_stat.st_size, digest))
+        digests[filepath] = digest
+
+    with journal:
+        journal.executemany('INSERT OR REPLACE INTO inputs VALUES (?, ?, ?, ?)', changed_inputs)
+
+    return digests
+
+
+def update_input_manifest(journal, noske_clean_files_dict, journal_state, update=False, in_place=True):
+    """
+    A konvertálandó NoSkE fájlokhoz feljegyzi a NoSkE és a clean bemenet hash-ét. Frissítéskor (update) a már
+    (részben) konvertált fájlok közül azokat, amelyeknek a NoSkE vagy a clean bemenete megváltozott, a teljes
+    clean csoportjukkal együtt (a clean div-ek sorszáma az előző részek div-jeinek számától függ) újrakonvertálásra
+    jelöli. A DOC sorszámuk nem változik.
+    :param in_place: a kimenet könyvtár, a régi kimenet törölhető. Zip kimenetnél (False) a megváltozott bemenetű
+                     fájlok miatt a napló módosítása előtt hibával áll le, így a napló továbbra is a zip-et írja le.
+    :return: az újrakonvertálandó fájlok DOC sorszámai (a régi kimenetüket törölni kell)
+    """
+    manifest = {noske_fname: (noske_digest, clean_file, clean_digest)
+                for noske_fname, noske_digest, clean_file, clean_digest
+                in journal.execute('SELECT noske_file, noske_digest, clean_file, clean_digest FROM files')}
+    if update:
+        checked_files = noske_clean_files_dict
+    else:
+        checked_files = {noske_file: clean_file for noske_file, clean_file in noske_clean_files_dict.items()
+                         if journal_state[os.path.basename(noske_file)][1:] == (0, None)}
+    digests = get_input_digests(journal, (filepath for noske_file, clean_file in checked_files.items()
+                                          for filepath in (noske_file, clean_file)))
+    current_manifest = {os.path.basename(noske_file): (digests[os.path.abspath(noske_file)],
+                                                       os.path.abspath(clean_file),
+                                                       digests[os.path.abspath(clean_file)])
+                        for noske_file, clean_file in checked_files.items()}
+
+    outdated_clean_files = set()
+    for noske_fname, current_inputs in current_manifest.items():
+        if journal_state[noske_fname][1:] != (0, None) and manifest[noske_fname] != current_inputs:
+            outdated_clean_files.update((manifest[noske_fname][1], current_inputs[1]))
+
+    outdated_parent_numbers = []
+    new_manifest = []
+    for noske_fname, (noske_digest, clean_file, clean_digest) in current_manifest.items():
+        parent_number, num_of_done_divs, num_of_divs = journal_state[noske_fname]
+        if (num_of_done_divs, num_of_divs) != (0, None):
+            if clean_file not in outdated_clean_files:
+                continue
+            outdated_parent_numbers.append(parent_number)
+            journal_state[noske_fname] = (parent_number, 0, None)
+        new_manifest.append((noske_digest, clean_file, clean_digest, noske_fname))
+
+    if len(outdated_parent_numbers) > 0 and not in_place:
+        raise SystemExit(f'The inputs of {len(outdated_parent_numbers)} converted NoSkE files changed, '
+                         f'a zip output cannot be updated in place, start a new conversion with -c')
+
+    with journal:
+        journal.executemany('UPDATE files SET num_of_done_divs = 0, num_of_divs = NULL, noske_digest = ?, '
+                            'clean_file = ?, clean_digest = ? WHERE noske_file = ?', new_manifest)
+
+    return outdated_parent_numbers
+
+
+def remove_outputs(corpora_dir, parent_numbers):
+    for parent_number in parent_numbers:
+        shutil.rmtree(os.path.join(corpora_dir, f'DOC{gen_docname("000000", parent_number)}'), ignore_errors=True)
+
+
+def record_progress(journal, journal_records):
+    """
+    :param journal_records: (NoSkE fájlnév, kész child sorszám, None) egy div után és
+                            (NoSkE fájlnév, None, div-ek száma) a fájl végén
+    """
+    with journal:
+        for noske_fname, child_folder_number, num_of_divs in journal_records:
+            if num_of_divs is None:
+                journal.execute('UPDATE files SET num_of_done_divs = ? WHERE noske_file = ?',
+                                (child_folder_number, noske_fname))
+            else:
+                journal.execute('UPDATE files SET num_of_divs = ? WHERE noske_file = ?', (num_of_divs, noske_fname))
+
+
+def scan_clean_files(iglob_pattern, manifest_filepath=None):
+    """
+    Az iglob(iglob_pattern, recursive=True)-val megegyező (a rejtett fájlok és mappák nélküli) fájllista
+    os.scandir-rel. A minta első, joker karakter nélküli mappáját járja be, majd a mintára illeszkedő fájlokat adja
+    vissza. A manifest_filepath SQLite fájlban mappánként tárolja az almappák és a fájlok listáját, egy mappát csak
+    akkor olvas be újra, ha az mtime-ja megváltozott (fájl vagy almappa létrehozása, törlése, átnevezése).
+    :return: az illeszkedő fájlok elérési útjai, rendezve
+    """
+    pattern_parts = iglob_pattern.split(os.sep)
+    root_parts = []
+    for pattern_part in pattern_parts:
+        if PAT_GLOB_MAGIC.search(pattern_part):
+            break
+        root_parts.append(pattern_part)
+    if len(root_parts) == len(pattern_parts):
+        return [iglob_pattern] if os.path.isfile(iglob_pattern) else []
+
+    # Relatív minta első része joker: a gyökér az aktuális mappa, de az elérési utak előtag nélküliek (mint iglob-nál)
+    root = os.sep if root_parts == [''] else os.sep.join(root_parts)
+    part_pats = tuple(part if part == '**' else re.compile(fnmatch.translate(part))
+                      for part in pattern_parts[len(root_parts):])
+
+    con = None if manifest_filepath is None else sqlite3.connect(manifest_filepath)
     try:
-        with open(backup_filepath, encoding='utf-8') as f:
-            for line in f:
-                processed_files.add(line.split()[0])
-                pass
-    except FileNotFoundError:
-        print('FileNotFound: creating new backup file.')
-        writing_backup_file(backup_filepath, True)
-        return 0, 0, None, set()
-
-    line = line.strip()
-    if len(line) > 0:
-        values = line.split()
-        if len(values) == 4:
-            if values[3] == 'False':
-                return int(values[1]) - 1, int(values[2]), values[0], processed_files
+        if con is not None:
+            con.executescript(CLEAN_MANIFEST_SCHEMA)
+            known_dirs = {path: (mtime_ns, subdirs, files)
+                          for path, mtime_ns, subdirs, files in con.execute('SELECT * FROM dirs')}
+        else:
+            known_dirs = {}
+
+        matched_files = []
+        changed_dirs = []
+        visited_dirs = set()
+        stack = [(root, ())]
+
+        while len(stack) > 0:
+            dir_path, rel_parts = stack.pop()
+            visited_dirs.add(dir_path)
+            try:
+                mtime_ns = os.stat(dir_path or os.curdir).st_mtime_ns
+            except OSError:
+                continue
+
+            known_dir = known_dirs.get(dir_path)
+            if known_dir is not None and known_dir[0] == mtime_ns:
+                subdirs, files = (names.split('\n') if names else [] for names in known_dir[1:])
             else:
-                return int(values[1]), 0, values[0], processed_files
+                subdirs, files = [], []
+                with os.scandir(dir_path or os.curdir) as entries:
+                    for entry in entries:
+                        if entry.name.startswith('.'):
+                            continue
+                        (subdirs if entry.is_dir() else files).append(entry.name)
+                changed_dirs.append((dir_path, mtime_ns, '\n'.join(subdirs), '\n'.join(files)))
+
+            if part_pats[-1] == '**':
+                matched_files.extend(os.path.join(dir_path, fname) for fname in files
+                                     if match_glob_parts(part_pats, (*rel_parts, fname)))
+            elif match_glob_parts(part_pats[:-1], rel_parts):
+                # A mappa illeszkedik, a fájlneveket elég a minta utolsó részével illeszteni
+                matched_files.extend(os.path.join(dir_path, fname) for fname in files
+                                     if part_pats[-1].match(fname) is not None)
+            stack.extend((os.path.join(dir_path, subdir), (*rel_parts, subdir)) for subdir in subdirs)
+
+        if con is not None:
+            with con:
+                con.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)', changed_dirs)
+                # A megszűnt mappák törlése (csak a bejárt gyökér alatt)
+                con.executemany('DELETE FROM dirs WHERE path = ?',
+                                ((path,) for path in known_dirs
+                                 if path not in visited_dirs and (path == root or
+                                                                  path.startswith(os.path.join(root, '')))))
+    finally:
+        if con is not None:
+            con.close()
+
+    return sorted(matched_files)
+
+
+def match_glob_parts(part_pats, path_parts):
+    """
+    A scan_clean_files() mintájának illesztése egy relatív elérési út részeire. A ** nulla vagy több mappának
+    felel meg, a többi rész a fnmatch.translate()-tel fordított reguláris kifejezés.
+    """
+    if len(part_pats) == 0:
+        return len(path_parts) == 0
+    if part_pats[0] == '**':
+        return any(match_glob_parts(part_pats[1:], path_parts[i:]) for i in range(len(path_parts) + 1))
+    return len(path_parts) > 0 and part_pats[0].match(path_parts[0]) is not None and \
+        match_glob_parts(part_pats[1:], path_parts[1:])
 
 
-def read(noske_clean_files_dict, last_file_index, processed_files):
-    for i, (noske_file, clean_file) in enumerate(noske_clean_files_dict.items()):
-        if i < last_file_index and \
-                os.path.splitext(os.path.basename(noske_file.replace('source.', '', 1)))[0] in processed_files:
+def match_noske_clean_files(noske_filepaths, clean_filepaths):
+    """
+    A NoSkE fájlok clean megfelelőjének megkeresése fájlnév alapján. A NoSkE fájlnevek source.-szal kezdődnek,
+    az egy clean fájlból szétvágott NoSkE fájlok (PAT_SPLITTED_FILES) a közös clean fájlhoz tartoznak.
+    :return: 1: {NoSkE fájl: clean fájl} a NoSkE fájlok rendezett sorrendjében,
+             2: a clean megfelelő nélküli NoSkE fájlok
+    """
+    input_clean_files = {os.path.splitext(os.path.basename(clean_filepath))[0]: clean_filepath
+                         for clean_filepath in clean_filepaths}
+    input_noske_files = {}
+    unmatched_files = []
+
+    for noske_file in sorted(noske_filepaths):
+        # Noske filenames start with source., this is the part which is cut down from filename
+        noske_to_clean_fname = os.path.basename(noske_file)[7:]
+        clean_file = input_clean_files.get(os.path.splitext(noske_to_clean_fname)[0], '')
+
+        if len(clean_file) == 0:
+            # Searching for files which were originally one file in clean xml but later splitted in noske
+            search_and_match = PAT_SPLITTED_FILES.search(noske_to_clean_fname)
+            # PAT_SPLITTED_FILES = re.compile(r'(.*?)(?:_\d{3})(\.clean)?\.mxml')
+
+            if search_and_match:
+                group_2 = search_and_match.group(2) or ''
+
+                if f'{search_and_match.group(1)}{group_2}' in input_clean_files:
+                    clean_file = input_clean_files[f'{search_and_match.group(1)}{group_2}']
+
+            if len(clean_file) == 0:
+                unmatched_files.append(noske_file)
+                continue
+
+        input_noske_files[noske_file] = clean_file
+
+    return input_noske_files, unmatched_files
+
+
+def gen_plan(noske_clean_files_dict, unmatched_files):
+    """
+    A --plan kimenete: a NoSkE --> clean megfeleltetés a clean fájlonkénti csoportokban (egy csoportban több,
+    szétvágott NoSkE fájl is lehet) és a clean megfelelő nélküli NoSkE fájlok. Nem nyitja meg a naplót.
+    """
+    noske_files_per_clean_file = {}
+    for noske_file, clean_file in noske_clean_files_dict.items():
+        noske_files_per_clean_file.setdefault(clean_file, []).append(noske_file)
+    groups = [{'clean_file': clean_file, 'noske_files': noske_files}
+              for clean_file, noske_files in noske_files_per_clean_file.items()]
+    return {'noske_files': len(noske_clean_files_dict),
+            'clean_files': len(set(noske_clean_files_dict.values())),
+            'split_groups': sum(len(group['noske_files']) > 1 for group in groups),
+            'groups': groups,
+            'unmatched': unmatched_files}
+
+
+def gen_status(journal_filepath):
+    """
+    A status parancs kimenete: a napló összesítése (kész, félbehagyott és még el sem kezdett NoSkE fájlok, kész
+    div-ek, a legnagyobb kiosztott DOC sorszám, shard módban a shard adatai). A bemeneteket nem olvassa be.
+    """
+    if not os.path.isfile(journal_filepath):
+        raise SystemExit(f'{journal_filepath} does not exist, no conversion was started with this journal')
+
+    with closing(open_journal(journal_filepath, False)) as journal:
+        num_of_files, num_of_done_files, num_of_partial_files, num_of_done_divs, last_parent_number = \
+            journal.execute('SELECT COUNT(*), COUNT(num_of_divs), '
+                            'SUM(num_of_divs IS NULL AND num_of_done_divs > 0), '
+                            'TOTAL(num_of_done_divs), MAX(parent_number) FROM files').fetchone()
+        num_of_hashed_inputs, = journal.execute('SELECT COUNT(*) FROM inputs').fetchone()
+        shard = journal.execute('SELECT shard_index, num_of_shards, output, corpus_name FROM shard').fetchone()
+
+    return {'journal': journal_filepath,
+            'noske_files': num_of_files,
+            'done_files': num_of_done_files,
+            'partial_files': num_of_partial_files or 0,
+            'pending_files': num_of_files - num_of_done_files - (num_of_partial_files or 0),
+            'done_divs': int(num_of_done_divs),
+            'last_doc_number': last_parent_number,
+            'hashed_inputs': num_of_hashed_inputs,
+            'shard': None if shard is None else dict(zip(('shard_index', 'num_of_shards', 'output', 'corpus_name'),
+                                                         shard))}
+
+
+def read(noske_clean_files_dict, journal_state, streaming=False):
+    """
+    :return: (NoSkE fájlnév, clean fájl, NoSkE XML vagy streaming módban elérési út (kész fájlnál None),
+              DOC sorszám, kész div-ek száma, div-ek száma, ha a fájl kész) tuple-ök
+    """
+    for noske_file, clean_file in noske_clean_files_dict.items():
+        noske_fname = os.path.basename(noske_file)
+        parent_number, num_of_done_divs, num_of_divs = journal_state[noske_fname]
+
+        if num_of_divs is not None:
+            # A kész fájlt nem kell megnyitni, csak a div-jei száma kell a clean div-ek sorszámához
+            yield noske_fname, clean_file, None, parent_number, num_of_done_divs, num_of_divs
+            continue
+
+        if streaming:
+            # Streaming módban a fájlt csak a process_documents() olvassa be, div-enként
+            yield noske_fname, clean_file, noske_file, parent_number, num_of_done_divs, None
+            continue
+
+        yield noske_fname, clean_file, read_noske_file(noske_file), parent_number, num_of_done_divs, None
+
+
+def read_noske_file(noske_file):
+    """
+    A NoSkE fájl memóriába képezve (mmap). Nem dekódolja a fájlt, és a tartalma csak a parse_noske_xml()-ben
+    kerül a memóriába, így a párhuzamos futtatás csoportjainak előre beolvasott fájljai sem foglalnak helyet.
+    """
+    with open(noske_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def parse_noske_xml(noske_xml):
+    """
+    :param noske_xml: a read_noske_file() kimenete
+    :return: a NoSkE fájl soup-ja. A bájtokat az lxml dekódolja, a teljes fájl str-ként (a ő és ű miatt
+             karakterenként 2 bájton) nem jön létre.
+    """
+    import_parsers()
+    return BeautifulSoup(noske_xml, 'xml', from_encoding='iso-8859-2')
+
+
+def stream_noske_divs(noske_filepath, chunked=False):
+    """
+    A NoSkE fájlt lxml.etree.iterparse-szal olvassa, így a teljes fájl helyett egyszerre csak egy
+    (legfelső szintű) div van a memóriában.
+    :param noske_filepath: a NoSkE fájl elérési útja
+    :param chunked: ha az első div-ben beágyazott div van (az egész egy dokumentumnak számít), a div helyett
+                    a darabolt feldolgozáshoz (gen_chunked_outputs()) ad vissza egy dict-et, amint az első beágyazott
+                    div elkezdődik, így a div nem kerül egészében a memóriába
+    :return: 1: a doc tag file attribútuma, 2: a div-eket a BeautifulSoup find_all('div') sorrendjében adó generátor
+    """
+    import_parsers()
+    context = etree.iterparse(noske_filepath, events=('start', 'end'), encoding='iso-8859-2',
+                              recover=True, huge_tree=True)
+    fname_wo_ext = None
+
+    for event, elem in context:
+        if event == 'start' and elem.tag == 'doc':
+            fname_wo_ext = elem.get('file')
+            break
+
+    return fname_wo_ext, _iter_stream_divs(context, chunked)
+
+
+def _iter_stream_divs(context, chunked=False):
+    div_depth = 0
+    is_first_div = True
+    top_div = None
+
+    for event, elem in context:
+        if elem.tag != 'div':
+            continue
+
+        if event == 'start':
+            div_depth += 1
+            if div_depth == 1:
+                top_div = elem
+            elif chunked and is_first_div:
+                # A legfelső div és a beágyazott div közötti, még nyitott elemek (a beágyazott div-vel együtt)
+                open_elems = [elem]
+                while open_elems[-1].getparent() is not top_div:
+                    open_elems.append(open_elems[-1].getparent())
+                yield {'context': context, 'div': top_div, 'open_elems': open_elems[::-1]}
+                return
+            continue
+
+        div_depth -= 1
+        if div_depth > 0:
             continue
 
-        with open(noske_file, encoding="iso-8859-2") as f:
-            # a kimeneti listát lehet, tuple-re kéne változtatni
-            yield os.path.basename(noske_file), clean_file, f.read()
+        # A find_all('div') a beágyazott div-eket is visszaadja, közvetlenül a szülőjük után.
+        # Ha már az első div-ben van beágyazott div, akkor az egész egy dokumentumnak számít.
+        inner_divs = list(elem.iter('div'))
+        if is_first_div and len(inner_divs) > 1:
+            yield elem
+            return
+
+        # A korábban feldolgozott div-ek törlése a fából. Az aktuális div-et még nem lehet, mert
+        # a mark_last() egy div-vel előre olvas, így egyszerre legfeljebb két div van a memóriában.
+        parent = elem.getparent()
+        while elem.getprevious() is not None:
+            del parent[0]
 
+        is_first_div = False
+        yield from inner_divs
 
-def gen_header_xml(header_type, corpora_dir=None, parent_dir=None, clean_xml=None, div=None, docid=None):
+
+def gen_header_xml(header_type, ces_header=None, div_meta=None, docid=None):
     """
 
     :param docid:
-    :param div:
-    :param parent_dir:
-    :param corpora_dir:
-    :param clean_xml:
+    :param div_meta: a clean div metaadatai (get_clean_div_meta())
+    :param ces_header: a clean XML cesHeader-e (get_ces_header())
     :param header_type:
 
-    options: 1. 'corpus_header'
-             2. '2nd_level_header': header of a complete XML
-             3. '3rd_level_header': header of part of the XML
+    options: 1. '2nd_level_header': header of a complete XML
+             2. '3rd_level_header': header of part of the XML (HEADER_3RD_LEVEL_TEMPLATE)
     :return:
     """
     if header_type == '2nd_level_header':
-        ces_header = PAT_CES_HEADER.search(clean_xml)
-        os.makedirs(os.path.join(corpora_dir, parent_dir), exist_ok=True)
-
-        with open(os.path.join(corpora_dir, parent_dir, 'header.xml'), 'w', encoding='utf-8') as outpf:
-            print('<?xml version="1.0" encoding="UTF-8"?>',
-                  '<?xml-model href="header.rng" '
-                  'type="application/xml" '
-                  'schematypens="http://relaxng.org/ns/structure/1.0"?>',
-                  '<!DOCTYPE idsCorpus PUBLIC "-//IDS//DTD IDS-XCES 1.0//EN" '
-                  '"http://corpora.ids-mannheim.de/idsxces1/DTD/ids.xcesdoc.dtd">',
-                  ces_header.group().replace('cesHeader', 'idsHeader'), sep='\n', file=outpf)
-        return
-
-    soup = BeautifulSoup(
-        '<?xml version="1.0" encoding="UTF-8"?>\n'
-        '<?xml-model href="header.rng" '
-        'type="application/xml" '
-        'schematypens="http://relaxng.org/ns/structure/1.0"?>'
-        '<!DOCTYPE idsCorpus PUBLIC "-//IDS//DTD IDS-XCES 1.0//EN" '
-        '"http://corpora.ids-mannheim.de/idsxces1/DTD/ids.xcesdoc.dtd">',
-        features='lxml')
+        return '\n'.join(('<?xml version="1.0" encoding="UTF-8"?>',
+                          '<?xml-model href="header.rng" '
+                          'type="application/xml" '
+                          'schematypens="http://relaxng.org/ns/structure/1.0"?>',
+                          '<!DOCTYPE idsCorpus PUBLIC "-//IDS//DTD IDS-XCES 1.0//EN" '
+                          '"http://corpora.ids-mannheim.de/idsxces1/DTD/ids.xcesdoc.dtd">',
+                          ces_header.replace('cesHeader', 'idsHeader'))) + '\n'
 
     if header_type == '3rd_level_header':
-        ids_header = soup.new_tag('idsHeader', attrs={'type': 'text'})  # parent: soup
-        soup.append(ids_header)
-        file_desc = soup.new_tag('fileDesc')  # parent: ids_header
-        ids_header.append(file_desc)
-        title_stmt = soup.new_tag('titleStmt')  # parent: file_desc
-        file_desc.append(title_stmt)
-        text_sigle = soup.new_tag('textSigle')  # parent: title_stmt, string = DOC00001.00001
-        title_stmt.append(text_sigle)
-        text_sigle.string = docid
-        t_title = soup.new_tag('t.title')  # parent: title_stmt, string = title
-        title_stmt.append(t_title)
-
-        content = div.find('head')
-        if content:
-            t_title.string = content.text
-
-        publication_stmt = soup.new_tag('publicationStmt')  # parent: file_desc
-        file_desc.append(publication_stmt)
-        source_desc = soup.new_tag('sourceDesc')  # parent: file_desc
-        file_desc.append(source_desc)
-        bibl_struct = soup.new_tag('biblStruct')  # parent: source_desc
-        source_desc.append(bibl_struct)
-        analytic = soup.new_tag('analytic')  # parent: bibl_struct
-        bibl_struct.append(analytic)
-        h_author = soup.new_tag('h.author')  # parent: analytic, string = author
-        analytic.append(h_author)
-
-        # <docAuthor>Addbot</docAuthor>
-        content = div.find('docauthor')
-        if content:
-            h_author.string = content.text
-
-        encoding_desc = soup.new_tag('encodingDesc')  # parent: idsHeader
-        ids_header.append(encoding_desc)
-        profile_desc = soup.new_tag('profileDesc')  # parent: idsHeader
-        ids_header.append(profile_desc)
-        creation = soup.new_tag('creation')  # parent: profileDesc
-        profile_desc.append(creation)
-        creat_date = soup.new_tag('creatDate')  # parent: creation, string = date
-        creation.append(creat_date)
-
-        # <date ISO8601="2013-03-02T14:36:02Z"></date>
-        content = div.find('date')
-        if content:
-            if isinstance(content, dict) and 'iso8601' in content.keys():
-                creat_date.string = content['iso8601']
-            else:
-                creat_date.string = content.text
+        return HEADER_3RD_LEVEL_TEMPLATE.format(text_sigle=format_header_text(docid, 4),
+                                                t_title=format_header_text(div_meta['head'], 4),
+                                                h_author=format_header_text(div_meta['docauthor'], 6),
+                                                creat_date=format_header_text(div_meta['date'], 4))
 
-    return soup
+    raise ValueError(f'Unknown header type: {header_type}')
+
+
+def format_header_text(value, indent):
+    """
+    Egy szöveg a HEADER_3RD_LEVEL_TEMPLATE-be, a BeautifulSoup prettify() kimenetével megegyezően: escape-elve,
+    a két végéről a szóközöket levágva, saját sorban. Az üres szöveg sora elmarad.
+    """
+    if value is None:
+        return ''
+    value = escape_xml(value).strip()
+    if len(value) == 0:
+        return ''
+    return f'{" " * indent}{value}\n'
 
 
 def gen_data_xml(data, docid):
+    import_parsers()
     soup = BeautifulSoup(
         '<?xml version="1.0" encoding="UTF-8"?>\n'
         '<?xml-model href="text.rng" type="application/xml" '
@@ -260,71 +724,343 @@ def gen_data_xml(data, docid):
     return soup
 
 
-def gen_annotated_xml(annot_types, docid, annotations_per_line, opt):
-    soup = BeautifulSoup(
-        '<?xml version="1.0" encoding="UTF-8"?>\n'
-        '<?xml-model href="span.rng" type="application/xml" '
-        'schematypens="http://relaxng.org/ns/structure/1.0"?>',
-        features='lxml')
+def gen_annotated_xml(annot_types, docid, token_table, offsets, opt):
+    """
+    A span réteg XML-jét szövegdarabokként (span-onként) generálja, BeautifulSoup fa építése nélkül, így a
+    write_outputs() közvetlenül a fájlba írhatja. A kimenet megegyezik a BeautifulSoup prettify() kimenetével.
+    A pozíciókat a compute_offsets() által egyszer kiszámolt offsets táblából veszi.
+    """
+    yield gen_span_layer_head(docid)
+    yield from gen_spans(annot_types, token_table, offsets, opt)
+    yield SPAN_LAYER_TAIL
 
-    from_index_sp = 0
-    from_index = 0
-    to_index = 0
-    iden = 0
-    LAYER_ATTRS['docid'] = docid
-    soup.append(soup.new_tag('layer', attrs=LAYER_ATTRS))
-    span_list = soup.new_tag('spanList')
 
-    for i, (is_space, annotations) in enumerate(annotations_per_line):
+def gen_span_layer_head(docid):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' \
+           '<?xml-model href="span.rng" type="application/xml" ' \
+           'schematypens="http://relaxng.org/ns/structure/1.0"?>\n' \
+           f'<layer{format_xml_attrs({**LAYER_ATTRS, "docid": docid})}>\n' \
+           ' <spanList>\n'
+
+
+def gen_spans(annot_types, token_table, offsets, opt, first_id=0):
+    """
+    A span réteg span-jai. A darabolt feldolgozásnál (gen_chunked_outputs()) darabonként hívódik, ekkor a tokenek
+    azonosítói first_id-tól indulnak.
+    """
+    if opt in BASE:
+        # sentences vagy paragraphs: csak a határokat kell végigjárni, a tokeneket nem
+        for from_index, to_index in zip(offsets[f'{opt}_from'], offsets[f'{opt}_to']):
+            yield f'  <span from="{from_index}" to="{to_index}">\n  </span>\n'
+
+    elif not annot_types:
+        for iden, (from_index, to_index) in enumerate(zip(offsets['token_from'], offsets['token_to']), first_id):
+            yield f'  <span from="{from_index}" id="s_{iden}" to="{to_index}">\n  </span>\n'
+
+    else:
+        # Az fs részfa csak az annotációktól függ, az ismétlődő annotáció tuple-ökét a gen_fs_fragment() cache-eli
+        columns = zip(offsets['token_from'], offsets['token_to'], zip(*(token_table[annot] for annot in annot_types)))
+
+        for iden, (from_index, to_index, values) in enumerate(columns, first_id):
+            yield f'  <span from="{from_index}" id="s_{iden}" to="{to_index}">\n' \
+                  f'{gen_fs_fragment(annot_types, values)}'
+
+
+@lru_cache(maxsize=FS_FRAGMENT_CACHE_SIZE)
+def gen_fs_fragment(annot_types, values):
+    """
+    Egy token fs részfája (1-3. szint, a 4. szinten bármennyi f következhet egymásután) a span záró tagjével együtt.
+    A magyar morfológiai elemzések (lemma, pos, msd) sokszor ismétlődnek, ezért a kész részfákat egy korlátos
+    LRU cache tárolja, a találati arányát a gen_fs_fragment.cache_info() adja meg.
+    :param annot_types: OPT_DICT[opt][0]
+    :param values: a token annot_types szerinti annotációi
+    """
+    fragment = [f'   <fs{format_xml_attrs(FS_ATTRS)}>\n'
+                f'    <f{format_xml_attrs(F2_ATTRS)}>\n'
+                '     <fs>\n']
+
+    for annot, value in zip(annot_types, values):
+        fragment.append(f'      <f{format_xml_attrs({**F4_ATTRS, "name": annot})}>\n')
+        value = escape_xml(value).strip()
+        if value:
+            fragment.append(f'       {value}\n')
+        fragment.append('      </f>\n')
+
+    fragment.append('     </fs>\n'
+                    '    </f>\n'
+                    '   </fs>\n'
+                    '  </span>\n')
+    return ''.join(fragment)
+
+
+def compute_offsets(token_table, state=None):
+    """
+    A mondatok és bekezdések karakterpozícióit a tokenekéiből (add_s_annotations()) számolja ki, ezeket használja
+    az összes span réteg.
+    :param state: a darabolt feldolgozásnál (gen_chunked_outputs()) az előző darabok utolsó tokenjének vége
+                  (token_to), valamint a következő mondat és bekezdés kezdete, a függvény frissíti
+    :return: {'token_from', 'token_to', 'sentences_from', 'sentences_to', 'paragraphs_from', 'paragraphs_to'}
+    """
+    token_to = token_table['token_to']
+    offsets = {'token_from': token_table['token_from'], 'token_to': token_to,
+               **{key: array('q') for key in ('sentences_from', 'sentences_to', 'paragraphs_from', 'paragraphs_to')}}
+
+    last_to_index = 0 if state is None else state['token_to']
+
+    for opt in ('sentences', 'paragraphs'):
+        from_index_sp = 0 if state is None else state[f'{opt}_from']
+
+        for stop in token_table[f'{opt}_stops']:
+            # a határ előtti utolsó token vége
+            to_index = token_to[stop - 1] if stop > 0 else last_to_index
+
+            if from_index_sp == to_index:
+                from_index_sp -= 1
+            offsets[f'{opt}_from'].append(from_index_sp)
+            offsets[f'{opt}_to'].append(to_index)
+            from_index_sp = to_index + 1
+
+        if state is not None:
+            state[f'{opt}_from'] = from_index_sp
+
+    if state is not None and len(token_to) > 0:
+        state['token_to'] = token_to[-1]
+
+    return offsets
+
+
+def check_offsets(text, token_spans, words=None, structure_spans=None):
+    """
+    A span rétegek pozícióinak ellenőrzése a nyers szöveghez képest: minden span a szövegen belül van, a tokenek
+    sorban követik egymást, a token span-ok szövege nem üres, nem kezdődik és nem végződik szóközzel, és ha ismert,
+    megegyezik a NoSkE szóalakkal. A mondatok és bekezdések (structure_spans) sorban követik egymást és token végén
+    végződnek. A konvertálás közben (check_div_offsets()) és a kimenet utólagos ellenőrzésekor (verify_text_folder())
+    is ez fut.
+    :param token_spans: (from, to) párok
+    :param words: a tokenek szóalakjai (vagy None)
+    :param structure_spans: {réteg: (from, to) párok}
+    :return: a hibák listája
+    """
+    errors = []
+    len_of_text = len(text)
+    token_ends = set()
+    last_to_index = 0
+
+    for iden, (from_index, to_index) in enumerate(token_spans):
+        token_ends.add(to_index)
+        last_to_index = check_token_span(errors, iden, from_index, to_index,
+                                         words[iden] if words is not None else None, len_of_text, last_to_index,
+                                         lambda from_index, to_index: text[from_index:to_index])
+
+    for layer, spans in (structure_spans or {}).items():
+        last_to_index = 0
+        for i, (from_index, to_index) in enumerate(spans):
+            last_to_index = check_structure_span(errors, layer, i, from_index, to_index, len_of_text, last_to_index,
+                                                 token_ends)
+
+    return [format_offset_error(error, len_of_text) for error in errors]
+
+
+def check_token_span(errors, iden, from_index, to_index, word, len_of_text, last_to_index, get_text):
+    """
+    A check_offsets() egy token span-ra. A szövegen kívüli span hibája (outside_error()) a szöveg hosszával a
+    format_offset_error()-ban kap végleges alakot, mert a darabolt ellenőrzésnél ez csak a dokumentum végén ismert.
+    :param get_text: (from, to) -> a szöveg része
+    :return: az utolsó szövegen belüli token vége
+    """
+    if not 0 <= from_index <= to_index <= len_of_text:
+        errors.append(outside_error(f'token s_{iden} ({from_index}-{to_index})'))
+        return last_to_index
+    if from_index < last_to_index:
+        errors.append(f'token s_{iden} ({from_index}-{to_index}) overlaps the previous token')
+
+    token = get_text(from_index, to_index)
+    if word is not None:
+        if token != word:
+            errors.append(f'token s_{iden} ({from_index}-{to_index}) is {token!r} in the text instead of {word!r}')
+    elif len(token) == 0 or token != token.strip():
+        errors.append(f'token s_{iden} ({from_index}-{to_index}) is {token!r} in the text')
+    return to_index
+
+
+def check_structure_span(errors, layer, i, from_index, to_index, len_of_text, last_to_index, token_ends):
+    """
+    A check_offsets() egy mondat vagy bekezdés span-ra.
+    :return: az utolsó szövegen belüli span vége
+    """
+    if not 0 <= from_index <= to_index <= len_of_text:
+        errors.append(outside_error(f'{layer} span {i} ({from_index}-{to_index})'))
+        return last_to_index
+    if from_index < last_to_index:
+        errors.append(f'{layer} span {i} ({from_index}-{to_index}) overlaps the previous span')
+    if len(token_ends) > 0 and to_index not in token_ends:
+        errors.append(f'{layer} span {i} ({from_index}-{to_index}) does not end at a token end')
+    return to_index
+
+
+def outside_error(span):
+    return (span,)
+
+
+def format_offset_error(error, len_of_text):
+    if isinstance(error, tuple):
+        return f'{error[0]} is outside of the text ({len_of_text})'
+    return error
+
+
+def new_chunk_check_state():
+    """
+    A check_chunk_offsets() állapota: az addigi nyers szöveg UTF-32-ben (karakterenként 4 bájt, így pozíció szerint
+    olvasható), az ellenőrzött tokenek száma, az utolsó token vége és az utolsó szövegen belüli token vége, a még nem
+    ellenőrizhető span-ok, valamint rétegenként az ellenőrzött span-ok száma és a hibák.
+    """
+    return {'text': bytearray(), 'num_of_tokens': 0, 'token_end': None, 'token_to': 0, 'pending_tokens': [],
+            'structures': {layer: {'num_of_spans': 0, 'to': 0, 'pending': []} for layer in ('sentences', 'paragraphs')},
+            'errors': {layer: [] for layer in ('tokens', 'sentences', 'paragraphs')}}
+
+
+def check_chunk_offsets(state, text, token_table, offsets, final=False):
+    """
+    A check_div_offsets() a darabolt feldolgozás (gen_chunked_outputs()) egy darabjára, a dokumentum szerinti
+    pozíciókkal és sorszámokkal. A span-ok a dokumentum addigi szövegéhez képest ellenőrződnek, az azon túl végződők
+    (és a tokenek sorrendje miatt az utánuk következők) a következő darabbal. A hibák a dokumentum végén, a
+    check_div_offsets() sorrendjében jönnek, így ugyanazok, mint a darabolás nélkül. Ehhez a dokumentum nyers
+    szövege a memóriában marad.
+    :param final: a dokumentum utolsó darabja
+    :return: az utolsó darabnál a dokumentum hibái, különben üres lista
+    """
+    state['text'] += text.encode('utf-32-le')
+    len_of_text = len(state['text']) // 4
+
+    def get_text(from_index, to_index):
+        return state['text'][4 * from_index:4 * to_index].decode('utf-32-le')
+
+    # Egy tokenek nélküli mondat vagy bekezdés az előző darab utolsó tokenjének végén végződik
+    token_ends = {state['token_end']} if state['token_end'] is not None else set()
+    pending_tokens = state['pending_tokens']
+    pending_tokens.extend(zip(offsets['token_from'], offsets['token_to'], token_table['word']))
+    num_of_checked = 0
+    for from_index, to_index, word in pending_tokens:
+        if not final and max(from_index, to_index) > len_of_text:
+            break
+        token_ends.add(to_index)
+        state['token_end'] = to_index
+        state['token_to'] = check_token_span(state['errors']['tokens'], state['num_of_tokens'], from_index, to_index,
+                                             word, len_of_text, state['token_to'], get_text)
+        state['num_of_tokens'] += 1
+        num_of_checked += 1
+    del pending_tokens[:num_of_checked]
+
+    for layer, layer_state in state['structures'].items():
+        pending_spans = layer_state['pending']
+        pending_spans.extend(zip(offsets[f'{layer}_from'], offsets[f'{layer}_to']))
+        num_of_checked = 0
+        for from_index, to_index in pending_spans:
+            if not final and max(from_index, to_index) > len_of_text:
+                break
+            layer_state['to'] = check_structure_span(state['errors'][layer], layer, layer_state['num_of_spans'],
+                                                     from_index, to_index, len_of_text, layer_state['to'], token_ends)
+            layer_state['num_of_spans'] += 1
+            num_of_checked += 1
+        del pending_spans[:num_of_checked]
+
+    if not final:
+        return []
+    return [format_offset_error(error, len_of_text) for errors in state['errors'].values() for error in errors]
+
+
+def check_div_offsets(data, token_table, offsets):
+    """
+    A check_offsets() a konvertálás közben (--verify), a kiírás előtt: a div nyers szövege, a token tábla
+    szóalakjai és a compute_offsets() pozíciói alapján, az XML újraolvasása nélkül.
+    """
+    return check_offsets(data, zip(offsets['token_from'], offsets['token_to']), token_table['word'],
+                         {opt: tuple(zip(offsets[f'{opt}_from'], offsets[f'{opt}_to']))
+                          for opt in ('sentences', 'paragraphs')})
+
+
+def read_layer_spans(layer_file):
+    """
+    Egy span réteg span-jai. A span rétegeket a gen_annotated_xml() állítja elő, ezért XML parser helyett
+    reguláris kifejezésekkel olvassa őket, ami nagyságrendekkel gyorsabb (a nyers szöveget tartalmazó data.xml-t
+    a verify_text_folder() XML parserrel olvassa).
+    :return: 1: (from, to) párok, 2: a span-ok szóalakjai, ha minden span fs-ében van word, különben None
+    """
+    layer_xml = layer_file.read()
+    spans = [(int(from_index), int(to_index)) for from_index, to_index in PAT_LAYER_SPAN.findall(layer_xml)]
+    words = [unescape_xml(word.decode('utf-8')) for word in PAT_WORD_FEATURE.findall(layer_xml)]
+    return spans, words if len(words) == len(spans) and len(words) > 0 else None
 
-        if not is_space and from_index > 0:
-            from_index -= 1
 
-        if annotations == 'SSTOP' or annotations == 'PSTOP':
-            if (annotations == 'SSTOP' and opt == 'sentences') or (annotations == 'PSTOP' and opt == 'paragraphs'):
-                if from_index_sp == to_index:
-                    from_index_sp -= 1
-                BASE_SPAN_ATTRS['from'] = f'{from_index_sp}'
-                BASE_SPAN_ATTRS['to'] = f'{to_index}'
-                span = soup.new_tag('span', attrs=BASE_SPAN_ATTRS)
-                span_list.append(span)
-                from_index_sp = to_index + 1
+def verify_text_folder(open_file, folder, fnames):
+    """
+    Egy kimeneti szöveg mappa (DOC.../...) ellenőrzése: a data.xml nyers szövegéhez képest a span rétegek
+    pozícióit a check_offsets() ellenőrzi, a token rétegek (OPT_DICT-beli, nem BASE rétegek) span-jainak meg kell
+    egyezniük a tokens.xml span-jaival.
+    :param open_file: a mappán belüli relatív elérési úthoz bináris fájl objektumot ad (könyvtár vagy zip)
+    :param fnames: a mappa fájljai (relatív elérési utak, pl. base/sentences.xml)
+    :return: a hibák listája, a mappa nevével
+    """
+    layer_files = {f'{OPT_DICT[opt][2]}/{OPT_DICT[opt][1]}.xml': opt for opt in OPT_DICT
+                   if opt not in ('header', 'data')}
+    if 'data.xml' not in fnames:
+        return [f'{folder}: data.xml is missing']
+
+    with open_file(f'{folder}/data.xml') as f:
+        # A data.xml-hez elég a standard könyvtár parsere, így az ellenőrzés nem tölti be az lxml-t
+        text = ElementTree.parse(f).findtext(f'{{{RAW_TEXT_ATTRS["xmlns"]}}}text') or ''
+
+    token_spans = None
+    words = None
+    structure_spans = {}
+    errors = []
+    # A tokens.xml az első, a többi token réteget ahhoz lehet hasonlítani
+    for fname in sorted((fname for fname in fnames if fname in layer_files),
+                        key=lambda fname: layer_files[fname] != 'word'):
+        opt = layer_files[fname]
+        with open_file(f'{folder}/{fname}') as f:
+            spans, layer_words = read_layer_spans(f)
+
+        if opt in BASE:
+            structure_spans[opt] = spans
             continue
+        if token_spans is None:
+            token_spans = spans
+        elif spans != token_spans:
+            errors.append(f'{fname}: the spans differ from the token spans')
+            continue
+        if words is None:
+            words = layer_words
 
-        to_index = from_index + len(annotations['word'])
-
-        # tag+number --> lowest the number the higher in hierarchy it is.
-        if opt not in BASE:
-            ANNOT_SPAN_ATTRS['id'] = f's_{iden}'
-            ANNOT_SPAN_ATTRS['from'] = f'{from_index}'
-            ANNOT_SPAN_ATTRS['to'] = f'{to_index}'
-            span = soup.new_tag('span', attrs=ANNOT_SPAN_ATTRS)
-
-            if annot_types:
-                # 1. szint
-                fs1 = soup.new_tag('fs', attrs=FS_ATTRS)
-                # 2. szint
-                f2 = soup.new_tag('f', attrs=F2_ATTRS)
-                # 3. szint
-                fs3 = soup.new_tag('fs')
-
-                for annot in annot_types:
-                    # 4.szint: bármennyi következhet egymásután
-                    F4_ATTRS['name'] = annot
-                    f4 = soup.new_tag('f', attrs=F4_ATTRS)
-                    f4.string = annotations[annot]
-                    fs3.append(f4)
-
-                span.append(fs1)
-                fs1.append(f2)
-                f2.append(fs3)
-            span_list.append(span)
+    errors.extend(check_offsets(text, token_spans or (), words, structure_spans))
+    return [f'{folder}: {error}' for error in errors]
 
-        from_index = to_index + 1
-        iden += 1
-    soup.layer.append(span_list)
 
-    return soup
+def escape_xml(value):
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def unescape_xml(value):
+    return value.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+
+
+def format_xml_attrs(attrs):
+    """
+    Az attribútumokat a BeautifulSoup kimenetével megegyezően (ábécérendben, escape-elve) formázza.
+    """
+    formatted_attrs = []
+
+    for key, value in sorted(attrs.items()):
+        value = escape_xml(value)
+        quote = '"'
+        if '"' in value:
+            if "'" in value:
+                value = value.replace('"', '&quot;')
+            else:
+                quote = "'"
+        formatted_attrs.append(f' {key}={quote}{value}{quote}')
+
+    return ''.join(formatted_attrs)
 
 
 def gen_xml(meta_dict, opt):
@@ -353,7 +1089,7 @@ def gen_xml(meta_dict, opt):
             '3rd_level_header',
             docid=f'{meta_dict["corpora_dir"]}/'
                   f'{meta_dict["parent_folder_name"]}.{meta_dict["child_folder_name"]}',
-            div=meta_dict['clean_div'])
+            div_meta=meta_dict['clean_div'])
 
     elif opt == 'data':
         output_xml = gen_data_xml(meta_dict['data'],
@@ -365,163 +1101,1439 @@ def gen_xml(meta_dict, opt):
         output_xml = gen_annotated_xml(OPT_DICT[opt][0],
                                        f'{meta_dict["corpora_dir"]}_'
                                        f'{meta_dict["parent_folder_name"]}.{meta_dict["child_folder_name"]}',
-                                       meta_dict['annotations_per_line'], opt)
+                                       meta_dict['token_table'], meta_dict['offsets'], opt)
 
     return {'output_xml': output_xml, 'output_xmlname': output_xmlname, 'annot_folder': annot_folder}
 
 
+def gen_krill_json(meta_dict, opts):
+    """
+    A KorAP-XML helyett (--format krill) a szöveg Krill által közvetlenül indexelhető JSON dokumentuma a token
+    táblából és a compute_offsets() pozícióiból, XML generálás és újraolvasás nélkül. A token pozíciókon a
+    KorAP-XML-Krill kimenetével megegyező alakú termek vannak: _<n>$<i>from<i>to, s: (szóalak), i: (kisbetűs
+    szóalak), <annotációs mappa>/<réteg>:<érték> a kiválasztott rétegek (opts) annotációiból, valamint a mondat-
+    és bekezdés span-ok (<>:base/s:s, <>:base/s:p) az első tokenjükön.
+    :return: a JSON dokumentum egy sorban
+    """
+    token_table = meta_dict['token_table']
+    offsets = meta_dict['offsets']
+    words = token_table['word']
+    data = meta_dict['data']
+    num_of_tokens = len(words)
+    stream = [[f'_{i}$<i>{from_index}<i>{to_index}', f's:{word}', f'i:{word.lower()}']
+              for i, (word, from_index, to_index) in enumerate(zip(words, offsets['token_from'], offsets['token_to']))]
+    foundries = {'base'}
+    layer_infos = {'base/s=spans'}
+
+    for opt, span_name, depth in (('paragraphs', 'p', 1), ('sentences', 's', 2)):
+        if opt not in opts:
+            continue
+        foundries.add(f'base/{opt}')
+        start_token = 0
+        for stop, from_index, to_index in zip(token_table[f'{opt}_stops'], offsets[f'{opt}_from'],
+                                              offsets[f'{opt}_to']):
+            if stop > start_token:
+                stream[start_token].append(f'<>:base/s:{span_name}$<b>64<i>{from_index}<i>{to_index}<i>{stop}'
+                                           f'<b>{depth}')
+            start_token = stop
+
+    annot_keys = {}
+    for opt in opts:
+        for annot in OPT_DICT[opt][0] or ():
+            if annot != 'word':
+                annot_keys[annot, f'{OPT_DICT[opt][2]}/{KRILL_LAYER_KEYS.get(annot, annot)}'] = None
+    for annot, key in annot_keys:
+        foundries.add(key.split('/')[0])
+        layer_infos.add(f'{key}=tokens')
+        for terms, value in zip(stream, token_table[annot]):
+            if value and value != '__NA__':
+                terms.append(f'{key}:{value}')
+
+    if num_of_tokens > 0:
+        stream[0][0:0] = [f'-:tokens$<i>{num_of_tokens}',
+                          *(f'-:base/{opt}$<i>{len(token_table[f"{opt}_stops"])}'
+                            for opt in ('paragraphs', 'sentences') if opt in opts),
+                          f'<>:base/s:t$<b>64<i>0<i>{len(data)}<i>{num_of_tokens}<b>0']
+
+    corpus_sigle = meta_dict['corpora_dir']
+    doc_sigle = f'{corpus_sigle}/{meta_dict["parent_folder_name"]}'
+    fields = [('corpusSigle', 'type:string', corpus_sigle), ('docSigle', 'type:string', doc_sigle),
+              ('textSigle', 'type:string', f'{doc_sigle}.{meta_dict["child_folder_name"]}')]
+    for key, tag_name in (('title', 'head'), ('author', 'docauthor')):
+        if meta_dict['clean_div'][tag_name]:
+            fields.append((key, 'type:text', meta_dict['clean_div'][tag_name].strip()))
+    creation_date = (meta_dict['clean_div']['date'] or '').strip()
+    if PAT_KRILL_DATE.fullmatch(creation_date):
+        fields.append(('creationDate', 'type:date', creation_date))
+
+    return json.dumps({'@context': KRILL_CONTEXT, 'version': '0.03',
+                       'fields': [{'@type': 'koral:field', 'key': key, 'type': field_type, 'value': value}
+                                  for key, field_type, value in fields],
+                       'data': {'text': data, 'name': 'tokens', 'tokenSource': 'noske#tokens',
+                                'foundries': ' '.join(sorted(foundries)), 'layerInfos': ' '.join(sorted(layer_infos)),
+                                'stream': stream}},
+                      ensure_ascii=False, separators=(',', ':'))
+
+
 def gen_docname(num_of_doc, i):
     num_of_doc = f'{num_of_doc[0:-len(str(i))]}{i}'
     return num_of_doc
 
 
-def get_data(div):
-    data = []
-    txt = div.text
+def new_token_table():
+    """
+    Oszlopos token tábla egy div-hez: az ANNOTATION_TYPES_ORDERED minden eleméhez egy (internált) string lista,
+    a tokenek karakterpozíciói (add_s_annotations()), a mondat- és bekezdéshatárok pedig az előttük lévő tokenek
+    számaként.
+    """
+    token_table = {annot_type: [] for annot_type in ANNOTATION_TYPES_ORDERED}
+    token_table['token_from'] = array('q')
+    token_table['token_to'] = array('q')
+    token_table['sentences_stops'] = array('q')
+    token_table['paragraphs_stops'] = array('q')
+    # Az első token kezdete, a darabolt feldolgozásnál (gen_chunked_outputs()) az előző darab utáni pozíció
+    token_table['start_index'] = 0
+    return token_table
+
+
+def clear_token_table(token_table, start_index):
+    """
+    A token tábla kiürítése helyben (a darabolt feldolgozás bejárása ugyanabba a táblába ír tovább).
+    """
+    for key, column in token_table.items():
+        if key != 'start_index':
+            del column[:]
+    token_table['start_index'] = start_index
+
 
+def tokenize_lines(txt, rows):
+    """
+    A NoSkE vertikális sorainak egymenetes feldolgozása, a nyers szöveg és az annotációk is ebből készülnek.
+    A nem üres sorok oszlopai a rows-ba kerülnek.
+    """
     for line in txt.split('\n'):
         line = line.strip()
 
         if len(line) > 0:
-            if line == '###NOSPACE###':
-                data.append('NoSpace')
-            else:
-                data.append(line.split('\t')[0])
+            rows.append(line.split('\t'))
 
-    return PAT_CUT_SPACE.sub('', ' '.join(data))
 
+def add_data(rows, data):
+    # A NoSpace (None) sor a nyers szövegbe is None-ként kerül (join_data())
+    data.extend([row and row[0] for row in rows])
 
-def get_annotations(tag_to_iterate, annotations_per_line):
-    for tag in tag_to_iterate:
 
-        if tag.name == 'div' or tag.name == 'sp':
-            get_annotations(tag, annotations_per_line)
+def join_data(data):
+    """
+    A nyers szöveg összeállítása a tokenekből: a tokenek közé szóköz kerül, kivéve, ahol NoSpace (None) van köztük.
+    """
+    return ''.join(' '.join(words) for is_nospace, words in groupby(data, partial(is_, None)) if not is_nospace)
 
-        elif tag.name is not None:
-            for s_tag in tag.find_all('s'):
-                if len(s_tag.text.strip()) == 0:
-                    continue
-                is_space = True
-                txt = s_tag.text.strip().split('\n')
 
-                for line in txt:
-                    line = line.strip()
+def add_s_annotations(rows, token_table):
+    """
+    Egy mondat sorainak (tokenize_lines(), a NoSpace helyén None) hozzáadása a token táblához. A tokenek
+    karakterpozíciói is itt számolódnak: NoSpace után a token nem kap előtte szóközt.
+    """
+    if len(rows) == 0:
+        return
+    num_of_columns = len(ANNOTATION_TYPES_ORDERED)
+    token_from = token_table['token_from']
+    token_to = token_table['token_to']
+    from_index = token_to[-1] + 1 if len(token_to) > 0 else token_table['start_index']
+    token_rows = []
+    is_space = True
+
+    for row in rows:
+        if row is None:
+            is_space = False
+            continue
 
-                    if len(line) == 0:
-                        continue
+        if not is_space and from_index > 0:
+            from_index -= 1
+        is_space = True
 
-                    if line == '###NOSPACE###':
-                        is_space = False
-                        continue
+        if len(row) != num_of_columns:
+            # No-ske: néha nincsen annyi tabok száma -1, amennyi hely az elemzésfajtákhoz kell
+            row = (row + ['__NA__'] * num_of_columns)[:num_of_columns]
 
-                    annotations = {}
-                    annotation_count = 0
+        token_rows.append(row)
+        to_index = from_index + len(row[0])
+        token_from.append(from_index)
+        token_to.append(to_index)
+        from_index = to_index + 1
 
-                    for k, annotation in enumerate(line.split('\t')[:11]):
-                        annotation_count = k
-                        annotations[ANNOTATION_TYPES_ORDERED[k]] = annotation
+    # A mondat sorainak oszlopokba fordítása egyben, soronkénti append helyett
+    for annot_type, column in zip(ANNOTATION_TYPES_ORDERED, zip(*token_rows)):
+        token_table[annot_type].extend(map(intern, column))
 
-                    if annotation_count < 10:
-                        # No-ske: néha nincsen annyi tabok száma -1, amennyi hely az elemzésfajtákhoz kell:
-                        start = 11 - (10 - annotation_count)
-                        for n in range(start, len(ANNOTATION_TYPES_ORDERED)):
-                            annotations[ANNOTATION_TYPES_ORDERED[n]] = '__NA__'
+    token_table['sentences_stops'].append(len(token_table['word']))
 
-                    annotations_per_line.append((is_space, annotations))
 
-                    if not is_space:
-                        is_space = True
+def get_data_and_annotations(div, token_table):
+    """
+    A div nyers szövege és annotációi a div egyetlen bejárásával. A bejárás a korábbi get_annotations() szerkezetét
+    követi: a div és sp gyerekeket rekurzívan, a többi gyerek <s> leszármazottait mondatként dolgozza fel, a <p>
+    gyerekek után bekezdéshatár van. Minden sort egyszer bont fel a tokenize_lines(), a <g/> (NoSpace) tag
+    a sorok között None-ként jelenik meg.
+    :return: a div nyers szövege
+    """
+    data = []
+    _walk_soup_container(div, data, token_table)
+    return join_data(data)
 
-                annotations_per_line.append((True, 'SSTOP'))
 
-            if tag.name == 'p':
-                annotations_per_line.append((True, 'PSTOP'))
+def _walk_soup_container(container, data, token_table):
+    """
+    :return: van-e <p> a container-ben
+    """
+    has_p = False
 
-    if tag_to_iterate.find('p') is None:
-        annotations_per_line.append((True, 'PSTOP'))
+    for child in container.children:
+        if child.name is None:
+            if type(child) in SOUP_TEXT_TYPES:
+                rows = []
+                tokenize_lines(child, rows)
+                add_data(rows, data)
 
+        elif child.name == 'div' or child.name == 'sp':
+            has_p |= _walk_soup_container(child, data, token_table)
 
-def process_documents(noske_inps, corpora_dir, last_parent_folder_number, last_child_folder_number, backup_filepath):
-    parent_folder_name = 'DOC'
-    parent_folder_number = '000000'
-    last_clean_xml_path = ''
-    last_len_of_divs = 0
-    start_div_number = 0
-    clean_divs = []
+        elif child.name == 'g':
+            data.append(None)
 
-    for i, (noske_fname, clean_xml_path, noske_xml) in enumerate(noske_inps, start=last_parent_folder_number + 1):
-        parent_folder_number = gen_docname(parent_folder_number, i)
-        child_folder_name = '000000'
+        else:
+            has_p |= _walk_soup_element(child, data, token_table)
 
-        # NoSkE soup létrehozása
-        noske_soup = BeautifulSoup(noske_xml.replace('<g/>', '###NOSPACE###'), 'xml')
+            if child.name == 'p':
+                token_table['paragraphs_stops'].append(len(token_table['word']))
 
-        # A doc tagen belüli fájlnév --> <doc file="lit_er_ambrus_l.s1.clean" ...>
-        noske_doc = noske_soup.find('doc')
-        fname_wo_ext = noske_doc['file']
+    if not has_p:
+        token_table['paragraphs_stops'].append(len(token_table['word']))
 
-        print(fname_wo_ext)
+    return has_p
 
-        # NoSkE div tag-listájának létrehozása. Egy div egyenlő egy dokumentummal
-        noske_divs = noske_soup.find_all('div')
 
-        if clean_xml_path == last_clean_xml_path:
-            start_div_number += last_len_of_divs
-        else:
-            start_div_number = 0
+def _walk_soup_element(elem, data, token_table):
+    has_p = elem.name == 'p'
 
-            # A NoSkE formátumban lévő fájlok clean megfelelője (metaadatokhoz, tehát header.xml-ekhez)
-            if len(clean_xml_path) > 1:
-                clean_xml = open(clean_xml_path, encoding='iso-8859-2').read()
-                clean_soup = BeautifulSoup(clean_xml, 'html.parser')
-            else:
-                continue
+    for child in elem.children:
+        if child.name is None:
+            if type(child) in SOUP_TEXT_TYPES:
+                rows = []
+                tokenize_lines(child, rows)
+                add_data(rows, data)
 
-            # clean div tag-listájának létrehozása.
-            clean_divs = clean_soup.find_all('div')
+        elif child.name == 's':
+            rows = []
+            nested_s_tags = []
+            has_p |= _collect_soup_s_rows(child, rows, nested_s_tags)
+            add_data(rows, data)
+            add_s_annotations(rows, token_table)
 
-        if len(noske_divs[0].find_all('div')) > 0:
-            noske_divs = noske_divs[0:1]
-            clean_divs = clean_divs[0:1]
+            # A find_all('s') a beágyazott mondatokat is visszaadta, ezek annotációi még egyszer bekerülnek
+            for nested_s_tag in nested_s_tags:
+                nested_rows = []
+                _collect_soup_s_rows(nested_s_tag, nested_rows, [])
+                add_s_annotations(nested_rows, token_table)
 
-        # Az egész bemeneti XML metaadatának (header-jének) legenerálása és kiírása
-        if last_child_folder_number == 0:
-            gen_header_xml('2nd_level_header', corpora_dir=corpora_dir,
-                           parent_dir=f'{parent_folder_name}{parent_folder_number}',
-                           clean_xml=clean_xml)
+        elif child.name == 'g':
+            data.append(None)
 
-        for j, div in enumerate(noske_divs):
-            if j < last_child_folder_number:
-                continue
-            child_folder_number = j + 1
-            clean_div = clean_divs[j + start_div_number]
-            child_folder_name = gen_docname(child_folder_name, child_folder_number)
-            annotations_per_line = []
-            data = get_data(div)
+        else:
+            has_p |= _walk_soup_element(child, data, token_table)
 
-            # A szövegrész elemzésének hozzáadása az annotations listához
-            get_annotations(div, annotations_per_line)
+    return has_p
 
-            meta_dict = {'fname_wo_ext': fname_wo_ext, 'annotations_per_line': annotations_per_line, 'data': data,
-                         'clean_div': clean_div, 'corpora_dir': os.path.basename(corpora_dir),
-                         'parent_folder_name': f'{parent_folder_name}{parent_folder_number}',
-                         'child_folder_name': child_folder_name}
 
-            for opt in OPTS:
-                yield gen_xml(meta_dict, opt), \
-                      meta_dict['parent_folder_name'], \
-                      meta_dict['child_folder_name']
+def _collect_soup_s_rows(tag, rows, nested_s_tags):
+    """
+    Egy <s> sorai (a <g/> helyén None), a beágyazott <s> tageket a nested_s_tags-be gyűjti.
+    """
+    has_p = False
 
-            is_last_subfile = True if j == len(noske_divs) - 1 else False
-            writing_backup_file(backup_filepath, False,
-                                (fname_wo_ext, f'{i}', f'{child_folder_number}', f'{is_last_subfile}'))
+    for child in tag.children:
+        if child.name is None:
+            if type(child) in SOUP_TEXT_TYPES:
+                tokenize_lines(child, rows)
+            continue
 
-        last_clean_xml_path = clean_xml_path
-        last_len_of_divs = len(noske_divs)
-        last_child_folder_number = 0
+        if child.name == 'g':
+            rows.append(None)
+            continue
 
+        if child.name == 's':
+            nested_s_tags.append(child)
+        elif child.name == 'p':
+            has_p = True
+        has_p |= _collect_soup_s_rows(child, rows, nested_s_tags)
 
-def str2bool(v):
+    return has_p
+
+
+def get_stream_data_and_annotations(div, token_table):
+    """
+    A get_data_and_annotations() megfelelője a stream_noske_divs() által adott lxml elemekre.
+    """
+    data = []
+    _walk_stream_container(div, data, token_table)
+    return join_data(data)
+
+
+def _walk_stream_container(container, data, token_table):
+    has_p = False
+    add_stream_text(container.text, data)
+
+    for child in container:
+        if child.tag == 'div' or child.tag == 'sp':
+            has_p |= _walk_stream_container(child, data, token_table)
+
+        elif child.tag == 'g':
+            data.append(None)
+
+        elif isinstance(child.tag, str):
+            has_p |= _walk_stream_element(child, data, token_table)
+
+            if child.tag == 'p':
+                token_table['paragraphs_stops'].append(len(token_table['word']))
+
+        add_stream_text(child.tail, data)
+
+    if not has_p:
+        token_table['paragraphs_stops'].append(len(token_table['word']))
+
+    return has_p
+
+
+def _walk_stream_element(elem, data, token_table):
+    has_p = elem.tag == 'p'
+    add_stream_text(elem.text, data)
+
+    for child in elem:
+        if child.tag == 's':
+            rows = []
+            nested_s_tags = []
+            has_p |= _collect_stream_s_rows(child, rows, nested_s_tags)
+            add_data(rows, data)
+            add_s_annotations(rows, token_table)
+
+            for nested_s_tag in nested_s_tags:
+                nested_rows = []
+                _collect_stream_s_rows(nested_s_tag, nested_rows, [])
+                add_s_annotations(nested_rows, token_table)
+
+        elif child.tag == 'g':
+            data.append(None)
+
+        elif isinstance(child.tag, str):
+            has_p |= _walk_stream_element(child, data, token_table)
+
+        add_stream_text(child.tail, data)
+
+    return has_p
+
+
+def add_stream_text(txt, data):
+    # Az lxml elemek text és tail értéke None, ha nincs szöveg
+    if txt:
+        rows = []
+        tokenize_lines(txt, rows)
+        add_data(rows, data)
+
+
+def iter_chunked_div(chunked_div, data, token_table):
+    """
+    A get_stream_data_and_annotations() megfelelője egy beágyazott div-es, egy dokumentumnak számító div-re
+    (stream_noske_divs(chunked=True)) a feldolgozás közben érkező iterparse eseményekből. A div és sp konténereket
+    eseményenként járja be, a többi gyereküket (pl. p) a _walk_stream_element() dolgozza fel, amint a következő
+    testvérük elkezdődik vagy a konténer véget ér (ekkor már a tail-jük is megvan), majd törli őket a fából.
+    A data-t és a token táblát helyben bővíti, minden gyerek után visszaadja a vezérlést, ekkor a hívó kiírhatja
+    és kiürítheti őket (gen_chunked_outputs()).
+    """
+    # Konténerenként: az elem, volt-e benne p, feldolgozva-e a text-je, és az eseményenként már bejárt gyerek
+    frames = [{'elem': chunked_div['div'], 'has_p': False, 'text_done': False, 'done_child': None}]
+    events = chain((('start', elem) for elem in chunked_div['open_elems']), chunked_div['context'])
+
+    for event, elem in events:
+        frame = frames[-1]
+
+        if event == 'start':
+            if elem.getparent() is not frame['elem']:
+                continue
+            yield from _walk_chunked_children(frame, data, token_table, elem)
+            if elem.tag == 'div' or elem.tag == 'sp':
+                frames.append({'elem': elem, 'has_p': False, 'text_done': False, 'done_child': None})
+
+        elif elem is frame['elem']:
+            yield from _walk_chunked_children(frame, data, token_table)
+            if not frame['has_p']:
+                token_table['paragraphs_stops'].append(len(token_table['word']))
+            frames.pop()
+            if len(frames) == 0:
+                return
+            frames[-1]['has_p'] |= frame['has_p']
+            frames[-1]['done_child'] = elem
+
+
+def _walk_chunked_children(frame, data, token_table, next_child=None):
+    """
+    A konténer next_child előtti (next_child None esetén az összes) gyerekének feldolgozása a
+    _walk_stream_container() szerint, majd törlése a fából.
+    """
+    container = frame['elem']
+
+    if not frame['text_done']:
+        add_stream_text(container.text, data)
+        frame['text_done'] = True
+
+    while len(container) > 0 and container[0] is not next_child:
+        child = container[0]
+
+        if child is frame['done_child']:
+            # Az eseményenként bejárt konténer gyereknek már csak a tail-je van hátra
+            frame['done_child'] = None
+        elif child.tag == 'div' or child.tag == 'sp':
+            frame['has_p'] |= _walk_stream_container(child, data, token_table)
+        elif child.tag == 'g':
+            data.append(None)
+        elif isinstance(child.tag, str):
+            frame['has_p'] |= _walk_stream_element(child, data, token_table)
+            if child.tag == 'p':
+                token_table['paragraphs_stops'].append(len(token_table['word']))
+
+        add_stream_text(child.tail, data)
+        del container[0]
+        yield
+
+
+def _collect_stream_s_rows(elem, rows, nested_s_tags):
+    """
+    A _collect_soup_s_rows() megfelelője lxml elemre. A kommentek szövege nem, csak az utánuk lévő szöveg számít.
+    """
+    has_p = False
+
+    if elem.text:
+        tokenize_lines(elem.text, rows)
+
+    for child in elem:
+        if child.tag == 'g':
+            rows.append(None)
+        elif isinstance(child.tag, str):
+            if child.tag == 's':
+                nested_s_tags.append(child)
+            elif child.tag == 'p':
+                has_p = True
+            has_p |= _collect_stream_s_rows(child, rows, nested_s_tags)
+
+        if child.tail:
+            tokenize_lines(child.tail, rows)
+
+    return has_p
+
+
+def get_clean_div_meta(div):
+    """
+    A 3rd_level_header-hez szükséges adatok egy clean div-ből. A hiányzó tag értéke None.
+    """
+    div_meta = {}
+
+    for tag_name in CLEAN_DIV_META_TAGS:
+        content = div.find(tag_name)
+        div_meta[tag_name] = content.text if content else None
+
+    return div_meta
+
+
+def get_ces_header(clean_xml):
+    """
+    A clean XML cesHeader-e. A cesHeader a fájl elején van, a keresés az első </cesHeader>-nél megáll.
+    """
+    start = clean_xml.find('<cesHeader')
+    if start == -1:
+        return None
+    end = clean_xml.find('</cesHeader>', start + len('<cesHeader') + 1)
+    if end == -1:
+        return None
+    return clean_xml[start:end + len('</cesHeader>')]
+
+
+def extract_clean_metadata(clean_xml_path):
+    """
+    A clean XML beolvasása és a header-ekhez szükséges metaadatok kinyerése.
+    :return: 1: cesHeader, 2: a div-ek metaadatainak listája
+    """
+    clean_xml = open(clean_xml_path, encoding='iso-8859-2').read()
+    import_parsers()
+    clean_soup = BeautifulSoup(clean_xml, 'html.parser')
+
+    # clean div tag-listájának létrehozása.
+    return get_ces_header(clean_xml), [get_clean_div_meta(div) for div in clean_soup.find_all('div')]
+
+
+def _extract_clean_metadata_with_stat(clean_xml_path):
+    clean_stat = os.stat(clean_xml_path)
+    return clean_xml_path, clean_stat.st_mtime_ns, clean_stat.st_size, extract_clean_metadata(clean_xml_path)
+
+
+def update_metadata_index(metadata_index, clean_xml_paths, jobs=1):
+    """
+    A clean fájlok metaadatainak SQLite indexe. Csak az új vagy megváltozott (mtime, méret) fájlokat dolgozza fel,
+    így az újrafuttatásoknak és az alkorpuszonkénti futtatásoknak már nem kell a clean fájlokat beolvasniuk.
+    """
+    with closing(sqlite3.connect(metadata_index)) as con:
+        con.executescript(METADATA_INDEX_SCHEMA)
+        indexed_files = {path: (mtime_ns, size)
+                         for path, mtime_ns, size in con.execute('SELECT path, mtime_ns, size FROM clean_files')}
+        outdated_paths = []
+
+        for clean_xml_path in clean_xml_paths:
+            clean_xml_path = os.path.abspath(clean_xml_path)
+            clean_stat = os.stat(clean_xml_path)
+            if indexed_files.get(clean_xml_path) != (clean_stat.st_mtime_ns, clean_stat.st_size):
+                outdated_paths.append(clean_xml_path)
+
+        if len(outdated_paths) == 0:
+            return
+
+        print(f'Indexing metadata of {len(outdated_paths)} clean files')
+
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=jobs)
+            extracted = executor.map(_extract_clean_metadata_with_stat, outdated_paths, chunksize=16)
+        else:
+            executor = None
+            extracted = map(_extract_clean_metadata_with_stat, outdated_paths)
+
+        try:
+            for clean_xml_path, mtime_ns, size, (ces_header, clean_divs) in extracted:
+                with con:
+                    con.execute('DELETE FROM clean_divs WHERE path = ?', (clean_xml_path,))
+                    con.execute('INSERT OR REPLACE INTO clean_files VALUES (?, ?, ?, ?)',
+                                (clean_xml_path, mtime_ns, size, ces_header))
+                    con.executemany('INSERT INTO clean_divs VALUES (?, ?, ?, ?, ?)',
+                                    ((clean_xml_path, div_index, *(div_meta[tag_name]
+                                                                   for tag_name in CLEAN_DIV_META_TAGS))
+                                     for div_index, div_meta in enumerate(clean_divs)))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+
+def load_clean_metadata(clean_xml_path, metadata_index=None):
+    """
+    A clean fájl metaadatai az indexből, ha van és benne van a fájl, különben a clean fájl feldolgozásával.
+    :return: 1: cesHeader, 2: a div-ek metaadatainak listája
+    """
+    if metadata_index is not None:
+        with closing(sqlite3.connect(metadata_index)) as con:
+            clean_file = con.execute('SELECT ces_header FROM clean_files WHERE path = ?',
+                                     (os.path.abspath(clean_xml_path),)).fetchone()
+            if clean_file is not None:
+                clean_divs = [dict(zip(CLEAN_DIV_META_TAGS, div_meta))
+                              for div_meta in con.execute(f'SELECT {", ".join(CLEAN_DIV_META_TAGS)} FROM clean_divs '
+                                                          f'WHERE path = ? ORDER BY div_index',
+                                                          (os.path.abspath(clean_xml_path),))]
+                return clean_file[0], clean_divs
+
+    return extract_clean_metadata(clean_xml_path)
+
+
+def new_telemetry(total_files=0, progress_interval=None):
+    """
+    A lépésenkénti idők (stages) és a feldolgozott mennyiségek gyűjtője. A progress_interval másodpercenként
+    report_progress() kiírja a haladást (a párhuzamos futtatás worker folyamataiban None).
+    """
+    start = time.perf_counter()
+    return {'stages': {}, 'files': 0, 'divs': 0, 'tokens': 0, 'output_files': 0, 'bytes_written': 0,
+            'fs_cache_hits': 0, 'fs_cache_misses': 0, 'start': start, 'last_progress': start,
+            'total_files': total_files, 'progress_interval': progress_interval}
+
+
+def add_stage_time(telemetry, stage, seconds):
+    telemetry['stages'][stage] = telemetry['stages'].get(stage, 0.0) + seconds
+
+
+def timed(telemetry, stage, func):
+    if telemetry is None:
+        return func
+
+    def timed_func(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            add_stage_time(telemetry, stage, time.perf_counter() - start)
+
+    return timed_func
+
+
+def timed_iter(telemetry, stage, iterable):
+    """
+    A lusta bemenetek (read(), stream_noske_divs()) munkája a következő elem kérésekor történik, ezt méri.
+    """
+    if telemetry is None:
+        return iterable
+
+    def timed_iterator():
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                add_stage_time(telemetry, stage, time.perf_counter() - start)
+            yield item
+
+    return timed_iterator()
+
+
+def gen_rendered_xml(telemetry, meta_dict, opt):
+    """
+    A gen_xml() bekapcsolt telemetriához: a kimenetet itt szerializálja, így a gen_xml:<opt> lépés idejébe
+    a lusta szövegdarabok (gen_annotated_xml()) és a prettify() is beletartozik, a write lépésbe csak az írás.
+    """
+    start = time.perf_counter()
+    output = gen_xml(meta_dict, opt)
+    output['output_xml'] = ''.join(get_output_chunks(output))
+    add_stage_time(telemetry, f'gen_xml:{opt}', time.perf_counter() - start)
+    return output
+
+
+def add_fs_cache_stats(telemetry, cache_info_before):
+    """
+    A gen_fs_fragment() cache találatainak hozzáadása a telemetriához a cache_info_before pillanatkép óta.
+    """
+    cache_info = gen_fs_fragment.cache_info()
+    telemetry['fs_cache_hits'] += cache_info.hits - cache_info_before.hits
+    telemetry['fs_cache_misses'] += cache_info.misses - cache_info_before.misses
+
+
+def merge_telemetry(telemetry, other_telemetry):
+    for key in ('files', 'divs', 'tokens', 'output_files', 'bytes_written', 'fs_cache_hits', 'fs_cache_misses'):
+        telemetry[key] += other_telemetry[key]
+    for stage, seconds in other_telemetry['stages'].items():
+        add_stage_time(telemetry, stage, seconds)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}'
+
+
+def report_progress(telemetry, force=False):
+    if telemetry['progress_interval'] is None:
+        return
+
+    now = time.perf_counter()
+    if not force and now - telemetry['last_progress'] < telemetry['progress_interval']:
+        return
+    telemetry['last_progress'] = now
+
+    elapsed = now - telemetry['start']
+    files_per_sec = telemetry['files'] / elapsed if elapsed > 0 else 0.0
+    if files_per_sec > 0:
+        eta = format_duration(max(telemetry['total_files'] - telemetry['files'], 0) / files_per_sec)
+    else:
+        eta = '?'
+    print(f'[{format_duration(elapsed)}] {telemetry["files"]}/{telemetry["total_files"]} files, '
+          f'{telemetry["divs"]} divs, {telemetry["tokens"]} tokens, '
+          f'{telemetry["bytes_written"] / 2 ** 20:.1f} MB written, {files_per_sec:.2f} files/s, ETA {eta}',
+          file=sys.stderr, flush=True)
+
+
+def gen_telemetry_report(telemetry):
+    elapsed = time.perf_counter() - telemetry['start']
+    return {'elapsed_seconds': round(elapsed, 3),
+            **{key: telemetry[key] for key in ('files', 'divs', 'tokens', 'output_files', 'bytes_written')},
+            'files_per_sec': round(telemetry['files'] / elapsed, 3),
+            'tokens_per_sec': round(telemetry['tokens'] / elapsed, 1),
+            'mb_written_per_sec': round(telemetry['bytes_written'] / 2 ** 20 / elapsed, 3),
+            'fs_fragment_cache': {'hits': telemetry['fs_cache_hits'], 'misses': telemetry['fs_cache_misses'],
+                                  'hit_rate': round(telemetry['fs_cache_hits'] /
+                                                    max(telemetry['fs_cache_hits'] + telemetry['fs_cache_misses'], 1),
+                                                    4)},
+            # Párhuzamos futtatásnál a worker folyamatok idejének összege
+            'stages': {stage: round(seconds, 3)
+                       for stage, seconds in sorted(telemetry['stages'].items(), key=lambda item: -item[1])},
+            'layers': gen_layer_costs(telemetry)}
+
+
+def gen_layer_costs(telemetry):
+    """
+    Rétegenként a generálás (gen_xml:<réteg>) ideje, az összes lépés idejéből vett aránya és a tokenenkénti ideje,
+    vagyis egy további réteg bekapcsolásának ára. A token tábla és a pozíciók az összes rétegé közösen.
+    """
+    total_seconds = sum(telemetry['stages'].values())
+    layer_costs = {}
+
+    for stage, seconds in telemetry['stages'].items():
+        if stage.startswith('gen_xml:'):
+            layer_costs[stage[len('gen_xml:'):]] = {
+                'seconds': round(seconds, 3),
+                'share': round(seconds / total_seconds, 4) if total_seconds else None,
+                'us_per_token': round(seconds * 1e6 / telemetry['tokens'], 3) if telemetry['tokens'] else None}
+
+    return layer_costs
+
+
+def write_telemetry_report(report_filepath, telemetry):
+    with open(report_filepath, 'w', encoding='utf-8') as f:
+        json.dump(gen_telemetry_report(telemetry), f, indent=2)
+        f.write('\n')
+
+
+def gen_chunked_outputs(chunked_div, meta_dict, opts, sentence_buffer, telemetry=None, verify=False):
+    """
+    Egy beágyazott div-es, egy dokumentumnak számító div (stream_noske_divs(chunked=True)) rétegeinek generálása
+    legalább sentence_buffer mondatos darabokban: az iter_chunked_div() bejárása közben, ha a token táblában elég
+    mondat gyűlt össze, a darab pozícióit a compute_offsets() az előző darabok állapotából számolja, a darab span-jai
+    és nyers szövege rétegenként egy ideiglenes fájlba (TMPDIR) kerülnek, a token tábla kiürül. A memória így a
+    dokumentum helyett a darab méretétől függ. A kimenet megegyezik a darabolás nélkülivel.
+    :param meta_dict: a process_documents() div-hez tartozó adatai (data és offsets nélkül)
+    :return: a rétegek kimenetei, az ideiglenes fájlokból olvasva (output_size: a fájl mérete bájtban)
+    """
+    docid = f'{meta_dict["corpora_dir"]}_{meta_dict["parent_folder_name"]}.{meta_dict["child_folder_name"]}'
+    token_table = meta_dict['token_table']
+    data = []
+    # Az előző darabok állapota: compute_offsets() (token_to, sentences_from, paragraphs_from), a tokenek és a nyers
+    # szöveg karaktereinek száma, valamint hogy a nyers szöveg szóval végződött-e (join_data())
+    state = {'token_to': 0, 'sentences_from': 0, 'paragraphs_from': 0, 'num_of_tokens': 0, 'len_of_data': 0,
+             'ends_with_word': False}
+    spool_files = {opt: tempfile.TemporaryFile('w+', encoding='utf-8') for opt in opts if opt != 'header'}
+    check_state = new_chunk_check_state() if verify else None
+
+    for opt, spool_file in spool_files.items():
+        if opt == 'data':
+            spool_file.write(str(gen_data_xml(DATA_PLACEHOLDER, docid)).split(DATA_PLACEHOLDER)[0])
+        else:
+            spool_file.write(gen_span_layer_head(docid))
+
+    def write_chunk(final=False):
+        text = join_data(data)
+        if len(data) > 0:
+            if state['ends_with_word'] and data[0] is not None:
+                text = f' {text}'
+            state['ends_with_word'] = data[-1] is not None
+        offsets = compute_offsets(token_table, state)
+
+        if verify:
+            for error in check_chunk_offsets(check_state, text, token_table, offsets, final):
+                print(f'{meta_dict["parent_folder_name"]}/{meta_dict["child_folder_name"]}: {error}', file=sys.stderr)
+
+        for opt, spool_file in spool_files.items():
+            start = time.perf_counter()
+            if opt == 'data':
+                spool_file.write(escape_xml(text))
+            else:
+                spool_file.writelines(gen_spans(OPT_DICT[opt][0], token_table, offsets, opt, state['num_of_tokens']))
+            if telemetry is not None:
+                add_stage_time(telemetry, f'gen_xml:{opt}', time.perf_counter() - start)
+
+        num_of_tokens = len(token_table['word'])
+        if telemetry is not None:
+            telemetry['tokens'] += num_of_tokens
+        state['num_of_tokens'] += num_of_tokens
+        state['len_of_data'] += len(text)
+        del data[:]
+        clear_token_table(token_table, state['token_to'] + 1 if state['num_of_tokens'] > 0 else 0)
+
+    walk = timed_iter(telemetry, 'get_data_and_annotations', iter_chunked_div(chunked_div, data, token_table))
+    for _ in walk:
+        if len(token_table['sentences_stops']) >= sentence_buffer:
+            write_chunk()
+    write_chunk(final=True)
+
+    for opt in opts:
+        if opt == 'header':
+            yield gen_xml(meta_dict, opt)
+            continue
+
+        spool_file = spool_files[opt]
+        if opt == 'data':
+            spool_file.write(str(gen_data_xml(DATA_PLACEHOLDER, docid)).split(DATA_PLACEHOLDER)[1])
+        else:
+            spool_file.write(SPAN_LAYER_TAIL)
+        spool_file.flush()
+        yield {'output_xml': iter_spool_file(spool_file), 'output_xmlname': OPT_DICT[opt][1],
+               'annot_folder': OPT_DICT[opt][2], 'output_size': os.fstat(spool_file.fileno()).st_size}
+
+
+def iter_spool_file(spool_file, block_size=1 << 20):
+    # A fájl az olvasás végén törlődik (TemporaryFile)
+    with spool_file:
+        spool_file.seek(0)
+        yield from iter(partial(spool_file.read, block_size), '')
+
+
+def process_documents(noske_inps, corpora_dir, journal, streaming=False, journal_records=None, metadata_index=None,
+                      telemetry=None, opts=OPTS, verify=False, output_format='korapxml', sentence_buffer=None):
+    """
+    :param noske_inps: a read() kimenete, az egy clean fájlhoz tartozó NoSkE fájlok egymás után
+                       (order_by_clean_file())
+    :param journal: a konverzió naplója (open_journal())
+    :param journal_records: ha meg van adva, a napló bejegyzései ebbe a listába kerülnek (párhuzamos futtatásnál
+                            a szülő folyamat írja be őket a naplóba, miután a kimenet kiíródott)
+    :param metadata_index: a clean fájlok metaadatainak indexe (update_metadata_index())
+    :param telemetry: ha meg van adva (new_telemetry()), a lépések ideje és a feldolgozott mennyiségek ide kerülnek
+    :param opts: a generált rétegek (OPT_DICT kulcsai), mind ugyanabból a token táblából készülnek
+    :param verify: a div-ek pozícióinak ellenőrzése a kiírás előtt (check_div_offsets()), a hibák a stderr-re kerülnek
+    :param output_format: korapxml vagy krill (szövegenként egy gzip-elt JSON, gen_krill_json())
+    :param sentence_buffer: streaming módban a beágyazott div-es, egy dokumentumnak számító div-ek darabolt
+                            feldolgozása legalább ennyi mondatos darabokban (gen_chunked_outputs()), csak korapxml
+                            kimenetnél
+    """
+    parent_folder_name = 'DOC'
+
+    # Kikapcsolt telemetria esetén a timed() és a timed_iter() magát a függvényt, illetve az iterátort adja vissza
+    parse_noske = timed(telemetry, 'parse', parse_noske_xml)
+    load_metadata = timed(telemetry, 'clean_metadata', load_clean_metadata)
+    get_offsets = timed(telemetry, 'compute_offsets', compute_offsets)
+    gen_output = gen_xml if telemetry is None else partial(gen_rendered_xml, telemetry)
+    gen_krill_output = timed(telemetry, 'gen_krill_json', gen_krill_json)
+
+    # Egy csoport: egy clean fájl és a belőle szétvágott NoSkE fájlok (PAT_SPLITTED_FILES) a részek sorrendjében
+    for clean_xml_path, group in groupby(timed_iter(telemetry, 'read', noske_inps), key=itemgetter(1)):
+        # A clean fájl metaadatai csoportonként egyszer, az első konvertálandó résznél töltődnek be
+        clean_metadata = None
+        # A rész első div-jének sorszáma a clean div-ek között: az előző részek div-jeinek száma
+        start_div_number = 0
+
+        for noske_fname, _, noske_xml, i, last_child_folder_number, num_of_divs in group:
+            parent_folder_number = gen_docname('000000', i)
+            child_folder_name = '000000'
+
+            # Egy korábbi futtatásban már elkészült fájl
+            if num_of_divs is not None:
+                start_div_number += num_of_divs
+                continue
+
+            if streaming:
+                # Streaming módban a noske_xml a NoSkE fájl elérési útja, a div-ek egyesével jönnek
+                fname_wo_ext, noske_divs = stream_noske_divs(
+                    noske_xml, chunked=sentence_buffer is not None and output_format == 'korapxml')
+                noske_divs = timed_iter(telemetry, 'parse', noske_divs)
+                parse_div = get_stream_data_and_annotations
+            else:
+                # NoSkE soup létrehozása
+                noske_soup = parse_noske(noske_xml)
+
+                # A doc tagen belüli fájlnév --> <doc file="lit_er_ambrus_l.s1.clean" ...>
+                noske_doc = noske_soup.find('doc')
+                fname_wo_ext = noske_doc['file']
+
+                # NoSkE div tag-listájának létrehozása. Egy div egyenlő egy dokumentummal
+                noske_divs = noske_soup.find_all('div')
+                parse_div = get_data_and_annotations
+
+            parse_div = timed(telemetry, 'get_data_and_annotations', parse_div)
+            print(fname_wo_ext)
+
+            if clean_metadata is None:
+                # A NoSkE formátumban lévő fájlok clean megfelelője (metaadatokhoz, tehát header.xml-ekhez)
+                if len(clean_xml_path) > 1:
+                    clean_metadata = load_metadata(clean_xml_path, metadata_index)
+                else:
+                    continue
+            ces_header, clean_divs = clean_metadata
+
+            # Streaming módban ezt a stream_noske_divs() végzi el
+            if not streaming and len(noske_divs[0].find_all('div')) > 0:
+                noske_divs = noske_divs[0:1]
+
+            # Az egész bemeneti XML metaadatának (header-jének) legenerálása és kiírása
+            if last_child_folder_number == 0 and output_format == 'korapxml':
+                yield {'output_xml': gen_header_xml('2nd_level_header', ces_header=ces_header),
+                       'output_xmlname': 'header', 'annot_folder': ''}, \
+                      f'{parent_folder_name}{parent_folder_number}', \
+                      ''
+
+            len_of_divs = 0
+            for j, (div, is_last_subfile) in enumerate(mark_last(noske_divs)):
+                len_of_divs = j + 1
+                if j < last_child_folder_number:
+                    continue
+                child_folder_number = j + 1
+                clean_div = clean_divs[j + start_div_number]
+                child_folder_name = gen_docname(child_folder_name, child_folder_number)
+                token_table = new_token_table()
+                meta_dict = {'fname_wo_ext': fname_wo_ext, 'token_table': token_table,
+                             'clean_div': clean_div, 'corpora_dir': os.path.basename(corpora_dir),
+                             'parent_folder_name': f'{parent_folder_name}{parent_folder_number}',
+                             'child_folder_name': child_folder_name}
+
+                if isinstance(div, dict):
+                    # Beágyazott div-es dokumentum darabolva, a tokeneket a telemetriához darabonként adja hozzá,
+                    # a végén a token tábla üres
+                    for output in gen_chunked_outputs(div, meta_dict, opts, sentence_buffer, telemetry, verify):
+                        yield output, meta_dict['parent_folder_name'], meta_dict['child_folder_name']
+                else:
+                    # A szövegrész nyers szövege és elemzésének hozzáadása a token táblához
+                    data = parse_div(div, token_table)
+                    meta_dict['data'] = data
+                    meta_dict['offsets'] = get_offsets(token_table)
+
+                    if verify:
+                        for error in check_div_offsets(data, token_table, meta_dict['offsets']):
+                            print(f'{meta_dict["parent_folder_name"]}/{child_folder_name}: {error}', file=sys.stderr)
+
+                    if output_format == 'krill':
+                        # DOC.../<szöveg>.json.gz
+                        yield {'output_xml': gen_krill_output(meta_dict, opts), 'output_xmlname': child_folder_name,
+                               'annot_folder': '', 'output_ext': '.json.gz'}, \
+                              meta_dict['parent_folder_name'], \
+                              ''
+                    else:
+                        for opt in opts:
+                            yield gen_output(meta_dict, opt), \
+                                  meta_dict['parent_folder_name'], \
+                                  meta_dict['child_folder_name']
+
+                if journal_records is None:
+                    record_progress(journal, ((noske_fname, child_folder_number, None),))
+                else:
+                    journal_records.append((noske_fname, child_folder_number, None))
+
+                if telemetry is not None:
+                    telemetry['divs'] += 1
+                    telemetry['tokens'] += len(token_table['word'])
+                    report_progress(telemetry)
+
+            if journal_records is None:
+                record_progress(journal, ((noske_fname, None, len_of_divs),))
+            else:
+                journal_records.append((noske_fname, None, len_of_divs))
+
+            if telemetry is not None:
+                telemetry['files'] += 1
+                report_progress(telemetry)
+
+            start_div_number += len_of_divs
+
+
+def order_by_clean_file(noske_clean_files_dict):
+    """
+    A NoSkE fájlok sorrendje úgy, hogy az egy clean fájlból szétvágott NoSkE fájlok (PAT_SPLITTED_FILES) a clean
+    fájl első előfordulásának helyén, a részek (fájlnév) sorrendjében egymás után következzenek. Így a
+    process_documents() és a group_by_clean_file() a bemenet sorrendjétől (pl. több mappából összegyűjtött NoSkE
+    fájlok) függetlenül csoportonként egyszer tölti be a clean fájl metaadatait.
+    :return: {NoSkE fájl: clean fájl}
+    """
+    noske_files_per_clean_file = {}
+    for noske_file, clean_file in noske_clean_files_dict.items():
+        noske_files_per_clean_file.setdefault(clean_file, []).append(noske_file)
+
+    return {noske_file: clean_file for clean_file, noske_files in noske_files_per_clean_file.items()
+            for noske_file in sorted(noske_files, key=os.path.basename)}
+
+
+def select_shard(noske_clean_files_dict, shard_index, num_of_shards):
+    """
+    A bemenet determinisztikus felosztása num_of_shards részre: az order_by_clean_file() szerinti clean fájl
+    csoportok sorban, körbeforgó módon kerülnek a shard-okba, így a szétvágott NoSkE fájlok egy shard-ba esnek.
+    A DOC sorszámok a teljes bemenet sorrendjéből jönnek (mint egy -c-vel indított, shard nélküli konvertálásnál),
+    így a shard-ok kimenete összefésülhető (merge_shards()).
+    :param shard_index: 1-től num_of_shards-ig
+    :return: 1: {NoSkE fájl: clean fájl} a shard-ban, 2: {NoSkE fájlnév: DOC sorszám} a teljes bemenetre
+    """
+    parent_numbers = {os.path.basename(noske_file): i for i, noske_file in enumerate(noske_clean_files_dict, start=1)}
+    shard_files = {}
+
+    for group_index, (_, group) in enumerate(groupby(noske_clean_files_dict.items(), key=itemgetter(1))):
+        if group_index % num_of_shards == shard_index - 1:
+            shard_files.update(group)
+
+    return shard_files, parent_numbers
+
+
+def group_by_clean_file(noske_inps):
+    """
+    A NoSkE fájlokat a clean megfelelőjük szerint csoportosítja (a bemenet az order_by_clean_file() sorrendjében
+    jön). Egy clean fájlból szétvágott NoSkE fájlokat egymás után, ugyanabban a folyamatban kell feldolgozni, mert
+    a clean div-ek sorszáma az előző részek div-jeinek számától függ. A DOC sorszámokat a load_journal() már előre
+    kiosztotta.
+    """
+    for _, group in groupby(noske_inps, key=itemgetter(1)):
+        yield list(group)
+
+
+def convert_group(corpora_dir, streaming, metadata_index, zip_output, with_telemetry, write_options, opts, verify,
+                  output_format, sentence_buffer, group):
+    """
+    Egy group_by_clean_file() által adott csoport konvertálása és kiírása egy külön folyamatban.
+    Zip kimenetnél a fájlokat itt tömöríti, a szülő folyamat csak beírja őket a zip-be (write_zip_entries()).
+    :param write_options: {'threads': háttérszálak száma a kiíráshoz (0: a process_documents() szálán),
+                           'queue_size': a kiírásra váró fájlok legnagyobb száma, 'fsync': minden fájl fsync-elése}
+    :param opts: a generált rétegek (parse_layers())
+    :param verify: a div-ek pozícióinak ellenőrzése (process_documents())
+    :param output_format: korapxml vagy krill (process_documents())
+    :param sentence_buffer: a darabolt feldolgozás mondatainak száma (process_documents())
+    :return: 1: a csoport napló bejegyzései, 2: a tömörített zip bejegyzések (ha zip_output),
+             3: a csoport telemetriája (ha with_telemetry, különben None)
+    """
+    journal_records = []
+    zip_entries = []
+    telemetry = new_telemetry() if with_telemetry else None
+    cache_info_before = gen_fs_fragment.cache_info()
+
+    if streaming:
+        noske_inps = group
+    else:
+        read_file = timed(telemetry, 'read', read_noske_file)
+        noske_inps = [(noske_fname, clean_xml_path, noske_file and read_file(noske_file), *journal_infos)
+                      for noske_fname, clean_xml_path, noske_file, *journal_infos in group]
+
+    if zip_output:
+        store = partial(compress_zip_output, os.path.basename(corpora_dir), zip_entries)
+    else:
+        store = partial(write_file_output, corpora_dir, fsync=write_options['fsync'])
+
+    outp = process_documents(noske_inps, corpora_dir, None, streaming, journal_records, metadata_index, telemetry,
+                             opts, verify, output_format, sentence_buffer)
+    if write_options['threads'] > 0:
+        # A szülő folyamat a napló bejegyzéseket csak a csoport végén, az összes kiírás után kapja meg
+        write_outputs_behind(outp, store, write_options['threads'], write_options['queue_size'], telemetry=telemetry)
+    else:
+        write_outputs(outp, store, telemetry)
+
+    if telemetry is not None:
+        add_fs_cache_stats(telemetry, cache_info_before)
+
+    return journal_records, zip_entries, telemetry
+
+
+def get_output_chunks(output):
+    output_xml = output['output_xml']
+
+    if isinstance(output_xml, str):
+        return output_xml,
+    elif BeautifulSoup is None or not isinstance(output_xml, BeautifulSoup):
+        # A span rétegek szövegdarabjai (gen_annotated_xml()) közvetlenül a fájlba kerülnek
+        return output_xml
+    elif 'data' in output['output_xmlname']:
+        # A prettify() két szóközt és egy entert rak a szöveg elejére, ami később problémát
+        # okozott az indexelésnél
+        return f'{output_xml}',
+    return f'{output_xml.prettify()}',
+
+
+def write_outputs(outp, store, telemetry=None):
+    """
+    :param store: a kimeneti fájlokat író függvény (write_file_output(), write_zip_output(),
+                  compress_zip_output()), paraméterei: relatív elérési út, szövegdarabok
+    :param telemetry: ha meg van adva (new_telemetry()), a kiírás ideje és a kiírt bájtok száma ide kerül
+    """
+    for outpf in outp:
+        chunks = get_output_chunks(outpf[0])
+        relpath = get_output_relpath(outpf)
+
+        if telemetry is None:
+            store(relpath, chunks)
+            continue
+
+        if 'output_size' in outpf[0]:
+            # A darabolt feldolgozás (gen_chunked_outputs()) rétegei az ideiglenes fájlból, darabonként íródnak ki
+            start = time.perf_counter()
+            store(relpath, chunks)
+            add_stage_time(telemetry, 'write', time.perf_counter() - start)
+            telemetry['output_files'] += 1
+            telemetry['bytes_written'] += outpf[0]['output_size']
+            continue
+
+        output_xml = ''.join(chunks)
+        start = time.perf_counter()
+        store(relpath, (output_xml,))
+        add_stage_time(telemetry, 'write', time.perf_counter() - start)
+        telemetry['output_files'] += 1
+        telemetry['bytes_written'] += len(output_xml.encode('utf-8'))
+
+
+def get_output_relpath(outpf):
+    return '/'.join(path_part for path_part in (''.join(outpf[1]), outpf[2], outpf[0]['annot_folder'],
+                                                os.path.splitext(outpf[0]['output_xmlname'])[0] +
+                                                outpf[0].get('output_ext', '.xml'))
+                    if path_part)
+
+
+def timed_store(store, relpath, chunks):
+    start = time.perf_counter()
+    store(relpath, chunks)
+    return time.perf_counter() - start
+
+
+def write_outputs_behind(outp, store, num_of_threads, max_pending, journal_records=None, on_written=None,
+                         telemetry=None):
+    """
+    A write_outputs() háttérszálas (write-behind) változata: a kimenetet a hívó szálon szerializálja, a kiírást
+    egy szálkészlet végzi, így a generálás nem vár a (pl. NFS-en lassú) írásra. Ha max_pending fájl vár kiírásra,
+    a generálás megáll, amíg a legrégebbi ki nem íródik. Az írási hibák a hívó szálon jelennek meg.
+    :param journal_records: a process_documents() ide teszi a napló bejegyzéseket
+    :param on_written: a napló bejegyzéseket csak azután kapja meg, hogy az előttük lévő összes kimenet kiíródott
+    """
+    # Kiírások (future, None) és napló bejegyzések (None, bejegyzések) a keletkezésük sorrendjében
+    pending = deque()
+    num_of_pending_writes = 0
+    num_of_records = 0
+
+    def drain(max_pending_writes):
+        # A sor elején lévő kész írások és napló bejegyzések feldolgozása. Ha max_pending_writes-nál több írás vár,
+        # a legrégebbire várni kell.
+        nonlocal num_of_pending_writes
+        start = time.perf_counter()
+
+        while len(pending) > 0:
+            future, records = pending[0]
+            if future is None:
+                on_written(records)
+            else:
+                if not future.done() and num_of_pending_writes <= max_pending_writes:
+                    break
+                write_seconds = future.result()
+                num_of_pending_writes -= 1
+                if telemetry is not None:
+                    add_stage_time(telemetry, 'write', write_seconds)
+            pending.popleft()
+
+        if telemetry is not None:
+            add_stage_time(telemetry, 'write_wait', time.perf_counter() - start)
+
+    def add_new_records():
+        # Egy div napló bejegyzése akkor kerül a listába, amikor a div összes kimenete már a sorban van
+        nonlocal num_of_records
+        if on_written is not None and len(journal_records) > num_of_records:
+            pending.append((None, journal_records[num_of_records:]))
+            num_of_records = len(journal_records)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=num_of_threads, thread_name_prefix='mnsz2korap-writer') as executor:
+        for outpf in outp:
+            add_new_records()
+            drain(max_pending - 1)
+
+            if 'output_size' in outpf[0]:
+                # A darabolt feldolgozás rétegeit az író szál olvassa ki az ideiglenes fájlból
+                chunks = get_output_chunks(outpf[0])
+                output_size = outpf[0]['output_size']
+            else:
+                output_xml = ''.join(get_output_chunks(outpf[0]))
+                chunks = (output_xml,)
+                output_size = len(output_xml.encode('utf-8')) if telemetry is not None else 0
+            pending.append((executor.submit(timed_store, store, get_output_relpath(outpf), chunks), None))
+            num_of_pending_writes += 1
+
+            if telemetry is not None:
+                telemetry['output_files'] += 1
+                telemetry['bytes_written'] += output_size
+
+        add_new_records()
+        drain(0)
+
+
+def write_file_output(corpora_dir, relpath, chunks, fsync=False):
+    filepath = os.path.join(corpora_dir, *relpath.split('/'))
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+    if relpath.endswith('.gz'):
+        # A Krill JSON kimenet (gen_krill_json()): fájlnév és időbélyeg nélküli gzip, így a kimenet reprodukálható
+        with open(filepath, 'wb') as raw_f:
+            with io.TextIOWrapper(gzip.GzipFile(filename='', mode='wb', fileobj=raw_f, compresslevel=6, mtime=0),
+                                  encoding='utf-8') as f:
+                f.writelines(chunks)
+
+            if fsync:
+                raw_f.flush()
+                os.fsync(raw_f.fileno())
+        return
+
+    with open(filepath, "w", encoding="utf-8") as f:
+        f.writelines(chunks)
+
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def write_zip_output(output_zip, corpus_name, relpath, chunks):
+    """
+    Folytatott konvertálásnál a félbeszakadt div már kiírt fájljai (és a 2nd_level_header) a zip-ben vannak, ezeket
+    nem írja ki újra, mert a zip-ben nem lehet felülírni őket, a tartalmuk pedig ugyanaz. Ha a fájl írása közben hiba
+    (vagy megszakítás) történik, a félig kiírt bejegyzést visszavonja, így a zip-ben csak teljes fájlok maradnak.
+    """
+    # A KorAP-XML zip-ekben a legfelső könyvtár a korpusz neve
+    name = f'{corpus_name}/{relpath}'
+    if zip_has_entry(output_zip, name):
+        return
+
+    try:
+        with io.TextIOWrapper(output_zip.open(name, 'w'), encoding='utf-8') as f:
+            f.writelines(chunks)
+    except BaseException:
+        zip_drop_entry(output_zip, name)
+        raise
+
+
+def compress_zip_output(corpus_name, zip_entries, relpath, chunks):
+    """
+    A párhuzamos zip kimenethez a worker folyamatok itt tömörítik a fájlokat, így a szülő folyamatnak
+    nem kell újratömörítenie őket.
+    """
+    data = ''.join(chunks).encode('utf-8')
+    zinfo = zipfile.ZipInfo(f'{corpus_name}/{relpath}', time.localtime()[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    compressed_data = compressor.compress(data) + compressor.flush()
+    zinfo.CRC = zlib.crc32(data)
+    zinfo.file_size = len(data)
+    zinfo.compress_size = len(compressed_data)
+    zip_entries.append((zinfo, compressed_data))
+
+
+def write_zip_entries(output_zip, zip_entries):
+    """
+    A compress_zip_output() által már tömörített bejegyzések írása a zip-be (zip_append_compressed()).
+    """
+    for zinfo, compressed_data in zip_entries:
+        if zip_has_entry(output_zip, zinfo.filename):
+            # Folytatott konvertálásnál a csoport egy korábbi futtatásban már kiírt fájlja (write_zip_output())
+            continue
+        zip_append_compressed(output_zip, zinfo, compressed_data)
+
+
+def zip_has_entry(output_zip, name):
+    try:
+        output_zip.getinfo(name)
+    except KeyError:
+        return False
+    return True
+
+
+# A zipfile nyilvános API-ja sem a már tömörített bejegyzések beírását, sem egy bejegyzés visszavonását nem
+# támogatja. Ezek a zipfile nem dokumentált belső állapotát (ZIP_INTERNALS) használják, kizárólag a
+# zip_append_compressed()-ben és a zip_drop_entry()-ben. A ZIP_INTERNALS_PYTHON_VERSIONS közötti Python verziók
+# zipfile-jával kipróbált, más verziónál a check_zip_internals() induláskor leállítja a zip kimenetű konvertálást.
+ZIP_INTERNALS_PYTHON_VERSIONS = ((3, 6), (3, 13))
+ZIP_INTERNALS = ('_lock', '_writecheck', '_didModify', 'start_dir', 'fp', 'filelist', 'NameToInfo')
+
+
+def check_zip_internals():
+    with zipfile.ZipFile(io.BytesIO(), 'w') as probe_zip:
+        missing_internals = [attr for attr in ZIP_INTERNALS if not hasattr(probe_zip, attr)]
+
+    min_version, max_version = ZIP_INTERNALS_PYTHON_VERSIONS
+    if not min_version <= sys.version_info[:2] <= max_version or len(missing_internals) > 0:
+        raise SystemExit(f'The zip output (-z) relies on zipfile internals that are tested with Python '
+                         f'{min_version[0]}.{min_version[1]}-{max_version[0]}.{max_version[1]} only, this is Python '
+                         f'{sys.version_info[0]}.{sys.version_info[1]}. Convert into a directory instead.')
+
+
+def zip_append_compressed(output_zip, zinfo, compressed_data):
+    """
+    Egy már tömörített bejegyzés beírása a zip végére, a ZipFile.mkdir() lépéseit követve.
+    """
+    with output_zip._lock:
+        output_zip.fp.seek(output_zip.start_dir)
+        zinfo.header_offset = output_zip.fp.tell()
+        output_zip._writecheck(zinfo)
+        output_zip._didModify = True
+        output_zip.filelist.append(zinfo)
+        output_zip.NameToInfo[zinfo.filename] = zinfo
+        output_zip.fp.write(zinfo.FileHeader())
+        output_zip.fp.write(compressed_data)
+        output_zip.start_dir = output_zip.fp.tell()
+
+
+def zip_drop_entry(output_zip, name):
+    """
+    Az utoljára beírt bejegyzés visszavonása: a félbeszakadt írás lezárásakor a zipfile a tartalomjegyzékbe is
+    felvette. A close() a tartalomjegyzéket a bejegyzés helyére írja, a fájl végét pedig itt kell levágni, mert
+    'w' módban a close() nem teszi meg.
+    """
+    with output_zip._lock:
+        zinfo = output_zip.NameToInfo.pop(name, None)
+        if zinfo is None:
+            return
+        output_zip.filelist.remove(zinfo)
+        output_zip.start_dir = zinfo.header_offset
+        output_zip.fp.seek(zinfo.header_offset)
+        output_zip.fp.truncate()
+
+
+def open_output_zip(zip_filepath, create_new):
+    if not create_new and os.path.exists(zip_filepath) and not zipfile.is_zipfile(zip_filepath):
+        raise SystemExit(f'{zip_filepath} is not a valid zip file (interrupted conversion?), '
+                         f'start a new conversion with -c')
+
+    return zipfile.ZipFile(zip_filepath, 'w' if create_new else 'a', zipfile.ZIP_DEFLATED)
+
+
+def record_shard(journal, journal_filepath, shard, output, corpus_name):
+    """
+    A shard sorszámának és kimenetének (a napló mappájához képest relatív elérési út, így a napló és a kimenet
+    együtt átmásolható egy másik gépre) feljegyzése a naplóba a merge_shards()-hez.
+    """
+    journal_dir = os.path.dirname(os.path.abspath(journal_filepath))
+    with journal:
+        journal.execute('DELETE FROM shard')
+        journal.execute('INSERT INTO shard VALUES (?, ?, ?, ?)',
+                        (*shard, os.path.relpath(os.path.abspath(output), journal_dir), corpus_name))
+
+
+def iter_shard_outputs(output_path, corpus_name):
+    """
+    Egy shard kimenetének fájljai: (relatív elérési út a korpusz mappán belül, tartalom) párok, könyvtárból vagy
+    zip-ből.
+    """
+    if zipfile.is_zipfile(output_path):
+        with zipfile.ZipFile(output_path) as shard_zip:
+            for zinfo in shard_zip.infolist():
+                if not zinfo.is_dir():
+                    yield zinfo.filename[len(corpus_name) + 1:], shard_zip.read(zinfo).decode('utf-8')
+        return
+
+    for dirpath, _, fnames in os.walk(output_path):
+        for fname in fnames:
+            filepath = os.path.join(dirpath, fname)
+            with open(filepath, encoding='utf-8') as f:
+                yield os.path.relpath(filepath, output_path).replace(os.sep, '/'), f.read()
+
+
+def merge_shards(shard_journal_filepaths, noske_clean_files_dict, corpora_dir, zip_filepath, journal_filepath,
+                 create_new, append=False):
+    """
+    A --shard k/N módban konvertált shard-ok összefésülése. Előbb ellenőrzi, hogy megvan-e mind az N shard, és
+    mindegyik a select_shard() szerinti összes NoSkE fájlját a teljes bemenet szerinti DOC sorszámmal befejezte.
+    Csak ezután másolja a shard-ok kimenetét (könyvtár vagy zip) a végső kimenetbe, a shard-ok naplóit pedig a
+    végső naplóba, amellyel a korpusz a továbbiakban (pl. -u) úgy kezelhető, mintha egy gépen készült volna.
+    """
+    corpus_name = os.path.basename(corpora_dir)
+    shards = {}
+    errors = []
+
+    for shard_journal_filepath in shard_journal_filepaths:
+        with closing(sqlite3.connect(shard_journal_filepath)) as shard_journal:
+            shard_row = shard_journal.execute('SELECT * FROM shard').fetchone()
+            if shard_row is None:
+                errors.append(f'{shard_journal_filepath}: not a shard journal')
+                continue
+            shard_index, num_of_shards, output, shard_corpus_name = shard_row
+            if shard_corpus_name != corpus_name:
+                errors.append(f'{shard_journal_filepath}: converted into {shard_corpus_name} instead of '
+                              f'{corpus_name} (the name of the output directory is part of the docids)')
+            shards[(shard_index, num_of_shards)] = \
+                (shard_journal_filepath,
+                 os.path.join(os.path.dirname(os.path.abspath(shard_journal_filepath)), output),
+                 shard_journal.execute('SELECT * FROM files').fetchall(),
+                 shard_journal.execute('SELECT * FROM inputs').fetchall())
+
+    num_of_shards = {num_of_shards for _, num_of_shards in shards}
+    if len(num_of_shards) > 1:
+        errors.append(f'the shards were converted with different numbers of shards: {sorted(num_of_shards)}')
+    elif len(num_of_shards) == 1:
+        num_of_shards = num_of_shards.pop()
+        missing_shards = [str(shard_index) for shard_index in range(1, num_of_shards + 1)
+                          if (shard_index, num_of_shards) not in shards]
+        if len(missing_shards) > 0:
+            errors.append(f'missing shards: {", ".join(missing_shards)} of {num_of_shards}')
+
+    for (shard_index, num_of_shards), (shard_journal_filepath, _, files, _) in sorted(shards.items()):
+        shard_files, parent_numbers = select_shard(noske_clean_files_dict, shard_index, num_of_shards)
+        converted_files = {noske_fname: (parent_number, num_of_divs)
+                           for noske_fname, parent_number, _, num_of_divs, *_ in files}
+        for noske_file in shard_files:
+            noske_fname = os.path.basename(noske_file)
+            if noske_fname not in converted_files or converted_files[noske_fname][1] is None:
+                errors.append(f'{shard_journal_filepath}: {noske_fname} is not converted')
+            elif converted_files[noske_fname][0] != parent_numbers[noske_fname]:
+                errors.append(f'{shard_journal_filepath}: {noske_fname} has DOC number '
+                              f'{converted_files[noske_fname][0]} instead of {parent_numbers[noske_fname]}')
+
+    if len(errors) > 0:
+        raise SystemExit('Cannot merge the shards:\n' + '\n'.join(errors))
+
+    # A korábbi kimenet csak az ellenőrzések után törölhető, különben egy hiányzó shard miatt elveszne
+    if create_new and not append:
+        try:
+            shutil.rmtree(corpora_dir)
+        except FileNotFoundError:
+            pass
+
+    journal = open_journal(journal_filepath, create_new)
+    if zip_filepath is not None:
+        output_zip = open_output_zip(zip_filepath, create_new)
+    else:
+        output_zip = None
+
+    try:
+        for shard_journal_filepath, output, files, inputs in shards.values():
+            print(f'Merging {output}')
+            if not os.path.exists(output):
+                # Ha N nagyobb, mint a clean fájl csoportok száma, a csoport nélküli shard nem hozza létre a
+                # kimenetét. A napló ellenőrzése szerint ilyenkor nincs is mit másolni belőle.
+                pass
+            elif output_zip is not None and zipfile.is_zipfile(output):
+                # Zip-ből zip-be a tömörített bejegyzések újratömörítés nélkül másolhatók
+                write_zip_entries(output_zip, read_zip_entries(output))
+            elif output_zip is not None:
+                zip_entries = []
+                for relpath, output_xml in iter_shard_outputs(output, corpus_name):
+                    compress_zip_output(corpus_name, zip_entries, relpath, (output_xml,))
+                write_zip_entries(output_zip, zip_entries)
+            elif zipfile.is_zipfile(output):
+                for relpath, output_xml in iter_shard_outputs(output, corpus_name):
+                    write_file_output(corpora_dir, relpath, (output_xml,))
+            else:
+                shutil.copytree(output, corpora_dir, dirs_exist_ok=True)
+
+            with journal:
+                journal.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', files)
+                journal.executemany('INSERT OR REPLACE INTO inputs VALUES (?, ?, ?, ?)', inputs)
+    finally:
+        if output_zip is not None:
+            output_zip.close()
+        journal.close()
+
+
+def read_zip_entries(zip_filepath):
+    """
+    A zip bejegyzései tömörítve, a write_zip_entries()-nek. A zipfile nyilvános API-ja csak kitömörítve adja
+    vissza őket, ezért a helyi fejléc után közvetlenül olvassa a tömörített adatot.
+    """
+    with zipfile.ZipFile(zip_filepath) as shard_zip, open(zip_filepath, 'rb') as f:
+        for zinfo in shard_zip.infolist():
+            f.seek(zinfo.header_offset)
+            local_header = f.read(zipfile.sizeFileHeader)
+            name_len, extra_len = int.from_bytes(local_header[26:28], 'little'), \
+                int.from_bytes(local_header[28:30], 'little')
+            f.seek(name_len + extra_len, os.SEEK_CUR)
+            new_zinfo = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+            for attr in ('compress_type', 'external_attr', 'CRC', 'file_size', 'compress_size'):
+                setattr(new_zinfo, attr, getattr(zinfo, attr))
+            yield new_zinfo, f.read(zinfo.compress_size)
+
+
+def mark_last(iterable):
+    """
+    Az elemek mellé azt is visszaadja, hogy az adott elem-e az utolsó (a streaming div-ek száma előre nem ismert).
+    """
+    iterator = iter(iterable)
+    try:
+        prev = next(iterator)
+    except StopIteration:
+        return
+
+    for item in iterator:
+        yield prev, False
+        prev = item
+
+    yield prev, True
+
+
+def str2bool(v):
     """
     Eldönti, hogy az argumentum Igaz, vagy Hamis értéket képvisel
     :param v: argumentum értéke
@@ -536,19 +2548,64 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
-def get_args():
+def parse_layers(v):
+    """
+    A --layers vesszővel elválasztott rétegeinek OPT_DICT kulcsokká alakítása. A rétegek a kulcsukkal
+    (pl. msd) vagy a kimeneti fájl nevével (pl. morpho) is megadhatók, a sorrend a megadott sorrend.
+    :param v: argumentum értéke
+    """
+    layer_names = {**{OPT_DICT[opt][1]: opt for opt in OPT_DICT}, **{opt: opt for opt in OPT_DICT}}
+    opts = []
+
+    for layer_name in v.split(','):
+        layer_name = layer_name.strip()
+        if layer_name not in layer_names:
+            raise argparse.ArgumentTypeError(f'Unknown layer: {layer_name} '
+                                             f'(available layers: {", ".join(OPT_DICT)})')
+        if layer_names[layer_name] not in opts:
+            opts.append(layer_names[layer_name])
+
+    return tuple(opts)
+
+
+def parse_shard(v):
+    """
+    A --shard k/N argumentum.
+    :param v: argumentum értéke
+    :return: (k, N)
+    """
+    try:
+        shard_index, num_of_shards = (int(number) for number in v.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Shard expected as k/N, e.g. 2/8.')
+    if not 1 <= shard_index <= num_of_shards:
+        raise argparse.ArgumentTypeError('Shard index must be between 1 and the number of shards.')
+    return shard_index, num_of_shards
+
+
+def get_args(argv=None, prog=None):
     """
     :param basp: folder of output
     :return: 1: folder of output, 2: folder of input
     """
 
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(prog=prog)
     parser.add_argument('input_noske_filepath', help='Path to NosKe files.', nargs="+")
     parser.add_argument('-d', '--output_dir', help='Path to output directory', nargs='?')
     parser.add_argument('-m', '--input_clean_iglob_filepath', help='Path of clean files root folder for iglob module.', nargs="?")
+    parser.add_argument('--manifest',
+                        help='Path of an SQLite cache of the clean files tree. Only the directories whose mtime '
+                             'changed since the previous run are listed again.',
+                        nargs='?', default=None)
+    parser.add_argument('--plan',
+                        help='Dry run: print the NoSkE -> clean file mapping grouped by clean file (split NoSkE '
+                             'files together) and the NoSkE files without a clean file as JSON, then exit.',
+                        nargs='?',
+                        type=str2bool, const=True, default=False)
     parser.add_argument('-b', '--backup_filepath',
-                        help='Path of backup file which contains informations about processed files.',
-                        nargs='?', default='./backup.txt')
+                        help='Path of the SQLite journal which contains informations about processed files '
+                             'and is used to resume an interrupted conversion.',
+                        nargs='?', default='./backup.sqlite')
     parser.add_argument('-c', '--create_new',
                         help='Create whole new output. In case of one would start to convert '
                              'the MNSZ to KorAp format from the beginning.',
@@ -557,42 +2614,166 @@ def get_args():
     parser.add_argument('-a', '--append', help='Append new annotation xml files to existed output KorAP-XML-s',
                         nargs='?',
                         type=str2bool, const=True, default=False)
+    parser.add_argument('-j', '--jobs',
+                        help='Number of worker processes. NoSkE files are converted in parallel, '
+                             'the output is identical to the serial run.',
+                        nargs='?', type=int, default=1)
+    parser.add_argument('-i', '--metadata_index',
+                        help='Path of an SQLite index of the clean files metadata. It is built or updated '
+                             '(only new and modified clean files) before the conversion and used instead of '
+                             'parsing the clean files.',
+                        nargs='?', default=None)
+    parser.add_argument('-z', '--zip',
+                        help='Write the output into this zip file (KorAP-XML zip layout, the top folder is the name '
+                             'of the output directory) instead of the output directory.',
+                        nargs='?', default=None)
+    parser.add_argument('-s', '--streaming',
+                        help='Read NoSkE files with lxml iterparse one div at a time instead of building '
+                             'a BeautifulSoup tree of the whole file.',
+                        nargs='?',
+                        type=str2bool, const=True, default=False)
+    parser.add_argument('--sentence_buffer',
+                        help='Convert the documents whose first div contains nested divs (converted as one text) '
+                             'in chunks of at least this many sentences: the offsets and the layers are written '
+                             'chunk by chunk into temporary files (TMPDIR), so the memory use depends on the chunk '
+                             'size instead of the document size. Implies -s, only for the korapxml format.',
+                        type=int, default=None)
+    parser.add_argument('-u', '--update',
+                        help='Reconvert the already converted NoSkE files whose NoSkE or clean input changed since '
+                             'the previous conversion (content hashes are stored in the journal). '
+                             'Their DOC numbers are kept.',
+                        nargs='?',
+                        type=str2bool, const=True, default=False)
+    parser.add_argument('-w', '--write_threads',
+                        help='Number of background threads writing the output files (write-behind), '
+                             '0 writes them in the converting thread. Only one thread writes into a zip output.',
+                        nargs='?', type=int, default=0)
+    parser.add_argument('--write_queue_size',
+                        help='Maximum number of output files waiting for the write-behind threads, the conversion '
+                             'waits when the queue is full.',
+                        nargs='?', type=int, default=64)
+    parser.add_argument('--fsync',
+                        help='fsync policy of the output: none, file (fsync every output file before its div is '
+                             'recorded in the journal, output directory only) or end (sync once at the end).',
+                        choices=('none', 'file', 'end'), default='none')
+    parser.add_argument('-l', '--layers',
+                        help='Comma separated list of the generated layers, by name (e.g. msd, word_phon) or by '
+                             f'output file name (e.g. tokens, morpho). Available layers: {", ".join(OPT_DICT)}. '
+                             f'Default: {",".join(OPTS)}.',
+                        type=parse_layers, default=OPTS)
+    parser.add_argument('--shard',
+                        help='Convert only shard k of N (k/N): the clean file groups of the input are distributed '
+                             'round-robin, DOC numbers are the ones of the whole input. Every shard needs its own '
+                             'output and journal, the shards are assembled with --merge.',
+                        type=parse_shard, default=None)
+    parser.add_argument('--merge',
+                        help='Journals of the converted shards. Checks that every shard converted all of its '
+                             'NoSkE files with the right DOC numbers, then copies the shard outputs into the output '
+                             'directory (or the -z zip) and their journals into the -b journal.',
+                        nargs='+', default=None)
+    parser.add_argument('-f', '--format',
+                        help='Output format: korapxml (KorAP-XML folders) or krill (one gzipped Krill JSON document '
+                             'per text, DOC.../<text>.json.gz, that KorAP-XML-Krill would produce from the KorAP-XML, '
+                             'with the annotations of the --layers). krill cannot be written into a zip.',
+                        choices=('korapxml', 'krill'), default='korapxml')
+    parser.add_argument('--verify',
+                        help='Check the character offsets of every div against its raw text before writing it '
+                             '(tokens match the NoSkE word forms, every span is inside the text, sentences and '
+                             'paragraphs end at token ends). Errors are printed to stderr. '
+                             'scripts/verify_korapxml.py checks an existing output.',
+                        nargs='?',
+                        type=str2bool, const=True, default=False)
+    parser.add_argument('-r', '--report',
+                        help='Path of a JSON report with the time spent in every stage of the conversion '
+                             '(summed over the worker processes in parallel mode), token, div and file counts, '
+                             'bytes written and throughput.',
+                        nargs='?', default=None)
+    parser.add_argument('-p', '--progress',
+                        help='Print the progress (files, tokens, bytes written, files/sec, ETA) to stderr '
+                             'every PROGRESS seconds.',
+                        nargs='?', type=float, const=60.0, default=None)
+    parser.add_argument('--cprofile',
+                        help='Profile the conversion with cProfile and write the pstats file here '
+                             '(only the main process in parallel mode).',
+                        nargs='?', default=None)
+
+    args = parser.parse_args(argv)
+    # A darabolt feldolgozás az iterparse eseményeiből dolgozik
+    args.streaming = args.streaming or args.sentence_buffer is not None
+
+    clean_filepaths = scan_clean_files(args.input_clean_iglob_filepath, args.manifest)
+    input_noske_files, unmatched_files = match_noske_clean_files(args.input_noske_filepath, clean_filepaths)
+    input_noske_files = order_by_clean_file(input_noske_files)
+    if args.shard is not None and args.merge is None:
+        input_noske_files, args.parent_numbers = select_shard(input_noske_files, *args.shard)
+    else:
+        args.parent_numbers = None
+    if len(unmatched_files) > 0 and not args.plan:
+        # Noske filenames start with source., this is the part which is cut down from filename
+        print('\n'.join(f'Failed to find MNSZ clean file for metadata for {os.path.basename(noske_file)[7:]}'
+                        for noske_file in unmatched_files))
 
-    args = parser.parse_args()
+    args.input_noske_filepath = input_noske_files
+    args.unmatched_noske_files = unmatched_files
+    args.input_clean_files = sorted(set(clean_filepaths))
 
-    input_clean_files = {os.path.splitext(os.path.basename(clean_filepath))[0]: clean_filepath
-                         for clean_filepath in iglob(args.input_clean_iglob_filepath, recursive=True)}
-    input_noske_files = {}
+    return vars(args)
 
-    for noske_file in sorted(args.input_noske_filepath):
-        # Noske filenames start with source., this is the part which is cut down from filename
-        noske_to_clean_fname = os.path.basename(noske_file)[7:]
-        clean_file = input_clean_files.get(os.path.splitext(noske_to_clean_fname)[0], '')
 
-        if len(clean_file) == 0:
-            # Searching for files which were originally one file in clean xml but later splitted in noske
-            search_and_match = PAT_SPLITTED_FILES.search(noske_to_clean_fname)
-            # PAT_SPLITTED_FILES = re.compile(r'(.*?)(?:_\d{3})(\.clean)?\.mxml')
+def get_status_args(argv, prog):
+    parser = argparse.ArgumentParser(prog=prog, description='Print the state of a conversion from its journal as JSON.')
+    parser.add_argument('-b', '--backup_filepath', help='Path of the SQLite journal of the conversion.',
+                        nargs='?', default='./backup.sqlite')
+    return vars(parser.parse_args(argv))
 
-            if search_and_match:
-                group_2 = search_and_match.group(2) or ''
 
-                if f'{search_and_match.group(1)}{group_2}' in input_clean_files:
-                    clean_file = input_clean_files[f'{search_and_match.group(1)}{group_2}']
+def main(argv=None):
+    """
+    Parancsok: plan, status, convert és verify. Parancs nélkül a convert fut (a korábbi hívások változatlanul
+    működnek). A bs4-et és az lxml-t csak a convert tölti be (import_parsers()).
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    prog = os.path.basename(sys.argv[0])
 
-            if len(clean_file) == 0:
-                print(f'Failed to find MNSZ clean file for metadata for {noske_to_clean_fname}')
-                continue
+    if len(argv) > 0 and argv[0] in COMMANDS:
+        command = argv[0]
+        argv = argv[1:]
+        prog = f'{prog} {command}'
+    else:
+        command = 'convert'
 
-        input_noske_files[noske_file] = clean_file
+    if command == 'status':
+        json.dump(gen_status(get_status_args(argv, prog)['backup_filepath']), sys.stdout, indent=2)
+        print()
+        return
 
-    args.input_noske_filepath = input_noske_files
+    if command == 'verify':
+        import verify_korapxml
+        verify_korapxml.main(argv, prog)
+        return
 
-    return vars(args)
+    args = get_args(argv, prog)
+    if command == 'plan':
+        args['plan'] = True
+    convert(args)
 
 
-def main():
-    args = get_args()
+def convert(args):
+    if args['plan']:
+        json.dump(gen_plan(args['input_noske_filepath'], args['unmatched_noske_files']), sys.stdout, indent=2)
+        print()
+        return
+
+    if args['format'] == 'krill' and args['zip'] is not None:
+        raise SystemExit('The krill format is written into the output directory, it cannot be used with -z.')
+
+    if args['zip'] is not None:
+        check_zip_internals()
+
+    if args['merge'] is not None:
+        merge_shards(args['merge'], args['input_noske_filepath'], args['output_dir'], args['zip'],
+                     args['backup_filepath'], args['create_new'], args['append'])
+        return
 
     if args['create_new'] and not args['append']:
         try:
@@ -600,36 +2781,110 @@ def main():
         except FileNotFoundError:
             pass
 
-    # Az legutóbbi kovertálás során keletkezett legutolsó fájl sorszámának betöltése
-    last_parent_folder_number, \
-    last_child_folder_number, \
-    last_documentum_name, \
-    processed_documents = loading_backup_file(args['backup_filepath'], args['create_new'])
+    # A korábbi konvertálások állapotának betöltése, a DOC sorszámok kiosztása
+    journal = open_journal(args['backup_filepath'], args['create_new'])
+    journal_state = load_journal(journal, args['input_noske_filepath'], args['parent_numbers'])
+    if args['shard'] is not None:
+        record_shard(journal, args['backup_filepath'], args['shard'], args['zip'] or args['output_dir'],
+                     os.path.basename(args['output_dir']))
     corpora_dir = args['output_dir']
 
+    # A bemenetek hash-einek feljegyzése, frissítéskor a megváltozott bemenetű fájlok újrakonvertálásra jelölése
+    try:
+        outdated_parent_numbers = update_input_manifest(journal, args['input_noske_filepath'], journal_state,
+                                                        args['update'], args['zip'] is None)
+    except SystemExit:
+        journal.close()
+        raise
+    if len(outdated_parent_numbers) > 0:
+        print(f'Reconverting {len(outdated_parent_numbers)} NoSkE files with changed inputs')
+        remove_outputs(corpora_dir, outdated_parent_numbers)
+
+    if args['metadata_index'] is not None:
+        update_metadata_index(args['metadata_index'], args['input_clean_files'], args['jobs'])
+
     # Noske fájlok az annotációk kinyeréséhez
-    noske_inp = read(args['input_noske_filepath'], last_parent_folder_number, processed_documents)
+    noske_inp = read(args['input_noske_filepath'], journal_state, args['streaming'] or args['jobs'] > 1)
 
-    # Clean fájlok a metaadatok kinyeréséhez (headerek)
-    outp = process_documents(noske_inp, corpora_dir, last_parent_folder_number, last_child_folder_number,
-                             args['backup_filepath'])
+    if args['report'] is not None or args['progress'] is not None:
+        telemetry = new_telemetry(sum(num_of_divs is None for _, _, num_of_divs in journal_state.values()),
+                                  args['progress'])
+    else:
+        telemetry = None
 
-    for outpf in outp:
-        parent_dir = ''.join(outpf[1])
-        child_dir = outpf[2]
-        annot_folder = outpf[0]['annot_folder']
-        os.makedirs(os.path.join(corpora_dir, parent_dir, child_dir, annot_folder), exist_ok=True)
-
-        with open(os.path.join(corpora_dir, parent_dir, child_dir,
-                               annot_folder, os.path.splitext(outpf[0]['output_xmlname'])[0] + '.xml'),
-                  "w", encoding="utf-8") as f:
-
-            if 'data' in outpf[0]['output_xmlname']:
-                # A prettify() két szóközt és egy entert rak a szöveg elejére, ami később problémát
-                # okozott az indexelésnél
-                f.write(f'{outpf[0]["output_xml"]}')
-            else:
-                f.write(f'{outpf[0]["output_xml"].prettify()}')
+    cache_info_before = gen_fs_fragment.cache_info()
+
+    if args['cprofile'] is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        profiler = None
+
+    write_options = {'threads': args['write_threads'], 'queue_size': args['write_queue_size'],
+                     'fsync': args['fsync'] == 'file'}
+    if args['zip'] is not None:
+        output_zip = open_output_zip(args['zip'], args['create_new'] and not args['append'])
+        store = partial(write_zip_output, output_zip, os.path.basename(corpora_dir))
+        # Egy zip-be egyszerre csak egy fájl írható
+        write_threads = min(args['write_threads'], 1)
+    else:
+        output_zip = None
+        store = partial(write_file_output, corpora_dir, fsync=write_options['fsync'])
+        write_threads = args['write_threads']
+
+    try:
+        if args['jobs'] > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            groups = group_by_clean_file(noske_inp)
+
+            with ProcessPoolExecutor(max_workers=args['jobs']) as executor:
+                # A napló csak azután kerül frissítésre, hogy a csoport kimenete kiíródott
+                for journal_records, zip_entries, group_telemetry in executor.map(
+                        partial(convert_group, corpora_dir, args['streaming'], args['metadata_index'],
+                                output_zip is not None, telemetry is not None, write_options, args['layers'],
+                                args['verify'], args['format'], args['sentence_buffer']),
+                        groups):
+                    if output_zip is not None:
+                        write_zip_entries(output_zip, zip_entries)
+                    record_progress(journal, journal_records)
+                    if telemetry is not None:
+                        merge_telemetry(telemetry, group_telemetry)
+                        report_progress(telemetry)
+            return
+
+        if write_threads > 0:
+            # A napló bejegyzéseit a write_outputs_behind() írja be, miután a div kimenete kiíródott
+            journal_records = []
+            outp = process_documents(noske_inp, corpora_dir, None, args['streaming'], journal_records,
+                                     args['metadata_index'], telemetry, args['layers'], args['verify'],
+                                     args['format'], args['sentence_buffer'])
+            write_outputs_behind(outp, store, write_threads, args['write_queue_size'], journal_records,
+                                 partial(record_progress, journal), telemetry)
+            return
+
+        # Clean fájlok a metaadatok kinyeréséhez (headerek)
+        outp = process_documents(noske_inp, corpora_dir, journal, args['streaming'],
+                                 metadata_index=args['metadata_index'], telemetry=telemetry, opts=args['layers'],
+                                 verify=args['verify'], output_format=args['format'],
+                                 sentence_buffer=args['sentence_buffer'])
+        write_outputs(outp, store, telemetry)
+    finally:
+        # A zip tartalomjegyzéke csak lezáráskor íródik ki
+        if output_zip is not None:
+            output_zip.close()
+        if args['fsync'] == 'end':
+            os.sync()
+        journal.close()
+
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args['cprofile'])
+        if telemetry is not None:
+            add_fs_cache_stats(telemetry, cache_info_before)
+            report_progress(telemetry, force=True)
+            if args['report'] is not None:
+                write_telemetry_report(args['report'], telemetry)
 
 
 if __name__ == '__main__':
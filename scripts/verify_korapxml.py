@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Az mnsz2korapxml.py kimenetének (könyvtár vagy zip) ellenőrzése: szöveg mappánként (DOC.../...) a span rétegek
+pozícióit veti össze a data.xml nyers szövegével (mnsz2korapxml.verify_text_folder()). A span rétegeket
+reguláris kifejezésekkel olvassa, a mappákat párhuzamosan ellenőrzi, így a teljes korpuszon is lefuttatható, mielőtt
+a Krill indexelés hibára futna. Az ellenőrzés nem tölti be a bs4-et és az lxml-t.
+"""
+
+import os
+import sys
+import zipfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+
+import mnsz2korapxml as m2k
+
+
+@lru_cache(maxsize=1)
+def open_output_zip(zip_filepath):
+    # Worker folyamatonként egyszer nyitja meg a zip-et
+    return zipfile.ZipFile(zip_filepath)
+
+
+def list_text_folders(output_path):
+    """
+    :return: (szöveg mappa, a mappa fájljai relatív elérési úttal) párok, a szöveg mappák azok, amelyekben
+             data.xml van vagy kellene lennie (header.xml-t tartalmazó DOC.../... mappa)
+    """
+    text_folders = {}
+
+    if zipfile.is_zipfile(output_path):
+        for name in open_output_zip(output_path).namelist():
+            # <korpusz>/DOC.../<szöveg>/<fájl>
+            name_parts = name.split('/')
+            if len(name_parts) >= 4 and not name.endswith('/'):
+                text_folders.setdefault('/'.join(name_parts[:3]), []).append('/'.join(name_parts[3:]))
+        return sorted(text_folders.items())
+
+    for doc_entry in os.scandir(output_path):
+        if not doc_entry.is_dir():
+            continue
+        for text_entry in os.scandir(doc_entry.path):
+            if text_entry.is_dir():
+                text_folders[f'{doc_entry.name}/{text_entry.name}'] = \
+                    [os.path.relpath(os.path.join(dirpath, fname), text_entry.path).replace(os.sep, '/')
+                     for dirpath, _, fnames in os.walk(text_entry.path) for fname in fnames]
+
+    return sorted(text_folders.items())
+
+
+def verify_text_folder(output_path, text_folder):
+    folder, fnames = text_folder
+
+    if zipfile.is_zipfile(output_path):
+        open_file = open_output_zip(output_path).open
+    else:
+        def open_file(relpath):
+            return open(os.path.join(output_path, *relpath.split('/')), 'rb')
+
+    try:
+        return m2k.verify_text_folder(open_file, folder, fnames)
+    except Exception as e:
+        return [f'{folder}: cannot be read: {e}']
+
+
+def get_args(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Check the character offsets of a KorAP-XML output of '
+                                                 'mnsz2korapxml.py against the raw texts.')
+    parser.add_argument('output_path', help='Output directory (the one given by -d) or zip file (-z).')
+    parser.add_argument('-j', '--jobs', help='Number of worker processes.', type=int, default=os.cpu_count())
+    parser.add_argument('--max_errors', help='Print at most this many errors.', type=int, default=1000)
+    return vars(parser.parse_args(argv))
+
+
+def main(argv=None, prog=None):
+    """
+    Az mnsz2korapxml.py verify parancsa is ezt hívja.
+    """
+    args = get_args(argv, prog)
+    text_folders = list_text_folders(args['output_path'])
+    num_of_errors = 0
+
+    with ProcessPoolExecutor(max_workers=args['jobs']) as executor:
+        for errors in executor.map(partial(verify_text_folder, args['output_path']), text_folders, chunksize=64):
+            for error in errors:
+                if num_of_errors < args['max_errors']:
+                    print(error)
+                num_of_errors += 1
+
+    print(f'{len(text_folders)} texts checked, {num_of_errors} errors', file=sys.stderr)
+    if num_of_errors > 0:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()